@@ -1,5 +1,8 @@
-from FarsightOPConv.core import FarsighOutputConverter, replaceLabels
-from FarsightOPConv.img32bit16bitIO import labelConv32bitTo16bit
+from FarsightOPConv.core import FarsighOutputConverter, LabelSeedIndex, replaceLabels, readSeeds, \
+    getLabelMembershipMask
+from FarsightOPConv.componentCache import ComponentCache, getFileContentHash, getComponentLabels
+from FarsightOPConv.img32bit16bitIO import iterLabelConv32bitTo16bit, loadImg16Stack, getLabelMapDF, \
+    getSequentialLabelMaps, labelConv32bitTo16bit
 from FarsightOPConv import tifffile
 from FarsightOPConv.sitkFuncs import getLabelShapeStatistics
 import pandas as pd
@@ -7,56 +10,198 @@ import numpy as np
 import pathlib as pl
 
 
-def farsightOPConvAndMetricsGen(farsightOPImageFile: str, farsightOPSeedsFile: str):
+def getImg16ShapeStatisticsDF(img16bit: np.ndarray, newLabels: np.ndarray, offset: tuple = None) -> pd.DataFrame:
+    """
+    Calculates shape statistics of the labels of a 16bit image, collected in columns (see getLabelShapeStatistics)
+    :param img16bit: numpy.ndarray of dtype numpy.uint16
+    :param newLabels: numpy.ndarray, labels of the 32bit label image corresponding to the labels of <img16bit>, in
+    ascending order of the latter
+    :param offset: tuple of ints, see getLabelShapeStatistics
+    :return: pandas.DataFrame, indexed by "New Label", with vector measures as tuples
+    """
+
+    measureArrays = getLabelShapeStatistics(img16bit, offset=offset, columnar=True)
+
+    imgStatsDF = pd.DataFrame({measureName: list(map(tuple, measureArray.tolist())) if measureArray.ndim > 1
+                               else measureArray
+                               for measureName, measureArray in measureArrays.items()})
+    imgStatsDF.sort_values(by="Label Value", inplace=True)
+    imgStatsDF["New Label"] = newLabels
+    imgStatsDF.rename(columns={"Label Value": "Temporary\nInternal Label"}, inplace=True)
+    imgStatsDF.set_index("New Label", inplace=True)
+
+    return imgStatsDF
+
+
+def shapeStatisticsDFGen(relabelledImageUInt32: np.ndarray, packing: str = "sequential", img16StackFile: str = None):
+    """
+    Calculates shape statistics of the labels of a 32bit label image, by converting it into 16bit images cropped to
+    their labels, one at a time (see iterLabelConv32bitTo16bit), and yielding the statistics of one 16bit image at a time
+    :param relabelledImageUInt32: numpy.ndarray of dtype numpy.uint32
+    :param packing: str, "sequential" or "compact", see labelConv32bitTo16bit. Statistics are mapped back to the labels
+    of <relabelledImageUInt32> using the label map.
+    :param img16StackFile: string, path of a ".npy" or ".tif"/".tiff" file. If specified, the 16bit images are not
+    cropped, but written into a memory-mapped stack in this file (see labelConv32bitTo16bit), from which they are read
+    one at a time (see img16StackShapeStatisticsDFGen), and the file is kept
+    :return: generator of pandas.DataFrame objects, indexed by "New Label", the labels of <relabelledImageUInt32>
+    """
+
+    assert packing in ("sequential", "compact"), \
+        "Shape statistics can only be calculated with sequential or compact packing"
+
+    if img16StackFile is not None:
+        _, labelMapDF = labelConv32bitTo16bit(relabelledImageUInt32, packing=packing, outFile=img16StackFile)
+        yield from img16StackShapeStatisticsDFGen(img16StackFile, labelMapDF)
+        return
+
+    for imgInd, img16bit, imgLabelMap, offset in iterLabelConv32bitTo16bit(relabelledImageUInt32, cropToLabels=True,
+                                                                           packing=packing):
+
+        # <imgLabelMap> is sorted by output label
+        yield getImg16ShapeStatisticsDF(img16bit, imgLabelMap["Input Label"].values, offset=offset)
+
+
+def img16StackShapeStatisticsDFGen(img16StackFile: str, labelMapDF: pd.DataFrame):
+    """
+    Calculates shape statistics of the labels of a 32bit label image from a stack of 16bit images written by
+    labelConv32bitTo16bit with the argument outFile, reading one 16bit image of the stack at a time
+    :param img16StackFile: string, path of the ".npy" or ".tif"/".tiff" file of the stack (see loadImg16Stack)
+    :param labelMapDF: pandas.DataFrame, label map returned by labelConv32bitTo16bit with sequential or compact packing
+    :return: generator of pandas.DataFrame objects, indexed by "New Label", the labels of the 32bit label image
+    """
+
+    img16Stack = loadImg16Stack(img16StackFile)
+
+    for imgInd in range(img16Stack.shape[0]):
+
+        imgLabelMap = labelMapDF.loc[labelMapDF["Output Image Index"].values == imgInd]
+
+        yield getImg16ShapeStatisticsDF(img16Stack[imgInd],
+                                        imgLabelMap.sort_values(by="Output Label")["Input Label"].values)
+
+
+def getStatisticsPacking(labels: np.ndarray) -> str:
+    """
+    Chooses the packing of labels into 16bit images for calculating shape statistics (see labelConv32bitTo16bit).
+    Labels are relabelled sequentially before packing only if this reduces the number of 16bit images, e.g., when many
+    labels of connected components without seeds have been removed
+    :param labels: numpy.ndarray of positive ints, labels of the 32bit label image
+    :return: str, "sequential" or "compact"
+    """
+
+    nLabelsImg16 = 2 ** 16 - 1
+
+    if labels.shape[0] and np.ceil(labels.max() / nLabelsImg16) > np.ceil(labels.shape[0] / nLabelsImg16):
+        return "compact"
+    else:
+        return "sequential"
+
+
+def getLabelPackingDF(labels: np.ndarray, packing: str) -> pd.DataFrame:
+    """
+    Calculates the sequential labels of labels, i.e., 1, 2, ..., <number of labels> in the order of the labels
+    (see getSequentialLabelMaps), and their labels in 16bit images with a packing (see getLabelMapDF)
+    :param labels: numpy.ndarray of positive ints, labels of the 32bit label image
+    :param packing: str, "sequential" or "compact"
+    :return: pandas.DataFrame, indexed by "New Label", with the columns "Sequential Label" and
+    "Temporary\nInternal Label"
+    """
+
+    labelPresence = np.zeros(int(labels.max(initial=0)) + 1, dtype=bool)
+    labelPresence[labels] = True
+
+    forwardMap, _ = getSequentialLabelMaps(labelPresence)
+    labelColours = forwardMap.astype(np.int64) - 1 if packing == "compact" else None
+    labelMapDF = getLabelMapDF(labelPresence, labelColours=labelColours)
+
+    inputLabels = labelMapDF["Input Label"].values
+
+    return pd.DataFrame({"Sequential Label": forwardMap[inputLabels].astype(np.int64),
+                         "Temporary\nInternal Label": labelMapDF["Output Label"].values.astype(np.int64)},
+                        index=pd.Index(inputLabels, name="New Label"))
+
+
+def farsightOPConvAndMetricsGen(farsightOPImageFile: str, farsightOPSeedsFile: str, nWorkers: int = 1,
+                                seedDriven: bool = False, cacheDir: str = None, img16StackFile: str = None):
     """
 
     :param farsightOPImageFile:
     :param farsightOPSeedsFile:
+    :param nWorkers: int, number of worker processes used for labelling connected components
+    :param seedDriven: bool, if True, only connected components containing seeds are labelled
+    (see FarsighOutputConverter.extractSeededComponents), which are numbered sequentially in the output
+    :param cacheDir: string, path of a directory in which connected components of <farsightOPImageFile> and their
+    shape statistics are stored, keyed by the content hash of <farsightOPImageFile> (see ComponentCache). Subsequent
+    runs with the same label image, e.g. with an edited seed file, reuse them and only calculate statistics of
+    connected components not in the cache. Cannot be used with <seedDriven>.
+    :param img16StackFile: string, path of a ".npy" or ".tif"/".tiff" file, into which the 16bit images used for
+    calculating shape statistics are written as a memory-mapped stack, so that they are held on disk and read one at a
+    time (see shapeStatisticsDFGen)
     :return:
+    The column "Sequential Label" of the output table contains the rank of every label among the output labels. If
+    this reduces the number of 16bit images, statistics are calculated with compact packing (see getStatisticsPacking),
+    and the column "Temporary\nInternal Label" contains the labels of the 16bit images of this packing, i.e., the
+    sequential labels modulo 65535, instead of the output labels modulo 65535. Both columns are derived from the
+    output labels (see getLabelPackingDF) and are the same with and without <cacheDir>.
     """
 
-    foc = FarsighOutputConverter(farsightOPImageFile, farsightOPSeedsFile)
+    assert not (seedDriven and cacheDir is not None), "Only one of the arguments seedDriven and cacheDir can be specified"
 
-    yield 0
+    componentCache = None
+    componentLabels = None
 
-    relabelledImage, newOldLabelDict = foc.separateMultipleLabels()
+    if cacheDir is None:
+        foc = FarsighOutputConverter(farsightOPImageFile, farsightOPSeedsFile)
+        seeds = foc.seeds
+    else:
+        componentCache = ComponentCache(cacheDir, getFileContentHash(farsightOPImageFile))
+        seeds = readSeeds(farsightOPSeedsFile)
 
     yield 0
 
-    newLabelsAll = np.unique(relabelledImage)[1:]
-    labelsDone = {x: False for x in newLabelsAll}
+    if componentCache is not None and componentCache.hasComponents():
+        relabelledImage, componentLabels = componentCache.loadComponents()
+    elif seedDriven:
+        relabelledImage, newOldLabelDict = foc.extractSeededComponents(dtype=np.uint32)
+    else:
+        if componentCache is not None:
+            foc = FarsighOutputConverter(farsightOPImageFile, farsightOPSeedsFile)
+        relabelledImage, newOldLabelDict = foc.separateMultipleLabels(nWorkers=nWorkers, dtype=np.uint32)
+        if componentCache is not None:
+            componentLabels = getComponentLabels(relabelledImage, foc.labelImage)
+            componentCache.saveComponents(relabelledImage, componentLabels)
 
-    newLabels = []
-    oldLabels = []
-    farsightOPSeeds = []
-
-    for ind, (x, y, z) in enumerate(foc.seeds):
-
-        # print(f"Doing {ind} of {foc.seeds.shape[0]}")
-        newLabel = relabelledImage[z, y, x]
-        oldLabel = foc.labelImage[z, y, x]
+    yield 0
 
-        if newLabel:
-            if not labelsDone[newLabel]:
+    # first seed of every new label, in the order of the seeds
+    seedNewLabels = relabelledImage[seeds[:, 2], seeds[:, 1], seeds[:, 0]]
+    newLabelSeedIndex = LabelSeedIndex(seedNewLabels)
+    firstSeedIndices = newLabelSeedIndex.getFirstSeedIndices()[newLabelSeedIndex.labels > 0]
+    firstSeedIndices.sort()
 
-                labelsDone[newLabel] = True
-                newLabels.append(newLabel)
-                oldLabels.append(oldLabel)
-                farsightOPSeeds.append((round(x, 6), round(y, 6), round(z, 6)))
+    newLabels = seedNewLabels[firstSeedIndices]
+    if componentLabels is None:
+        oldLabels = foc.getSeedLabels()[firstSeedIndices]
+    else:
+        oldLabels = componentLabels[newLabels]
+    farsightOPSeeds = [tuple(x) for x in seeds[firstSeedIndices].tolist()]
 
     yield 0
 
-    labels2Remove = [x for x, v in labelsDone.items() if not v]
+    if seedDriven:
+        relabelledImageUInt32 = relabelledImage
+    else:
+        # connected components are labelled sequentially
+        newLabelsAll = np.arange(1, relabelledImage.max() + 1, dtype=relabelledImage.dtype)
+        labels2Remove = list(np.setdiff1d(newLabelsAll, newLabels))
 
-    yields = []
-    for ret in replaceLabels(relabelledImage, labels2Remove, 0, makeGenerator=True):
-
-        yield 0
-        yields.append(ret)
+        yields = []
+        for ret in replaceLabels(relabelledImage, labels2Remove, 0, makeGenerator=True, inplace=True):
 
-    relabelledImageFiltered = yields[-1]
+            yield 0
+            yields.append(ret)
 
-    relabelledImageUInt32 = relabelledImageFiltered.astype(np.uint32)
+        relabelledImageUInt32 = yields[-1]
 
     yield 0
 
@@ -68,20 +213,43 @@ def farsightOPConvAndMetricsGen(farsightOPImageFile: str, farsightOPSeedsFile: s
     statsDF.set_index("New Label", inplace=True)
     statsDF.sort_index(inplace=True)
 
-    imgs16bit, labelMapDF = labelConv32bitTo16bit(relabelledImageUInt32)
+    packing = getStatisticsPacking(newLabels)
+
+    if componentCache is None:
+
+        for imgStatsDF in shapeStatisticsDFGen(relabelledImageUInt32, packing=packing, img16StackFile=img16StackFile):
+
+            yield 0
+            statsDF = statsDF.combine_first(imgStatsDF)
+
+    else:
+
+        cachedStatsDF = componentCache.loadStatistics()
+
+        # only statistics of connected components not in the cache are calculated
+        uncachedLabels = np.setdiff1d(newLabels, cachedStatsDF.index)
+        if uncachedLabels.shape[0]:
+
+            uncachedLabelsImage = np.zeros_like(relabelledImageUInt32)
+            np.copyto(uncachedLabelsImage, relabelledImageUInt32,
+                      where=getLabelMembershipMask(relabelledImageUInt32, uncachedLabels))
+
+            imgStatsDFs = [cachedStatsDF]
+            for imgStatsDF in shapeStatisticsDFGen(uncachedLabelsImage, packing=getStatisticsPacking(uncachedLabels),
+                                                   img16StackFile=img16StackFile):
+
+                yield 0
+                imgStatsDFs.append(imgStatsDF)
+
+            cachedStatsDF = pd.concat(imgStatsDFs)
+            componentCache.saveStatistics(cachedStatsDF)
 
-    for imgInd, img16bit in enumerate(imgs16bit):
+        statsDF = statsDF.combine_first(cachedStatsDF.loc[statsDF.index])
 
-        yield 0
-        measureNames, measureValues = getLabelShapeStatistics(img16bit)
-        imgStatsDF = pd.DataFrame(data=measureValues, columns=measureNames)
-        imgStatsDF.sort_values(by="Label Value", inplace=True)
-        imgLabelMap = labelMapDF[labelMapDF["Output Image Index"] == imgInd].copy()
-        imgLabelMap.sort_values(by="Output Label", inplace=True)
-        imgStatsDF["New Label"] = imgLabelMap["Input Label"].values
-        imgStatsDF.rename(columns={"Label Value": "Temporary\nInternal Label"}, inplace=True)
-        imgStatsDF.set_index("New Label", inplace=True)
-        statsDF = statsDF.combine_first(imgStatsDF)
+    # cached statistics were calculated with the labels of other 16bit images
+    labelPackingDF = getLabelPackingDF(newLabels, packing)
+    statsDF["Sequential Label"] = labelPackingDF["Sequential Label"]
+    statsDF["Temporary\nInternal Label"] = labelPackingDF["Temporary\nInternal Label"]
 
     ipImagePath = pl.Path(farsightOPImageFile)
     opImagePath = ipImagePath.parent / f"{ipImagePath.stem}_corrected32Bit{ipImagePath.suffix}"
@@ -96,11 +264,13 @@ def farsightOPConvAndMetricsGen(farsightOPImageFile: str, farsightOPSeedsFile: s
     yield str(opImagePath), str(opXLPath)
 
 
-def farsightOPConvAndMetrics(farsightOPImageFile: str, farsightOPSeedsFile: str):
+def farsightOPConvAndMetrics(farsightOPImageFile: str, farsightOPSeedsFile: str, nWorkers: int = 1,
+                             seedDriven: bool = False, cacheDir: str = None, img16StackFile: str = None):
 
     yields = []
 
-    for ret in farsightOPConvAndMetricsGen(farsightOPImageFile, farsightOPSeedsFile):
+    for ret in farsightOPConvAndMetricsGen(farsightOPImageFile, farsightOPSeedsFile, nWorkers=nWorkers,
+                                           seedDriven=seedDriven, cacheDir=cacheDir, img16StackFile=img16StackFile):
         yields.append(ret)
 
     return yields[-1]
@@ -0,0 +1,125 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+
+
+def getFileContentHash(filePath: str, blockSize: int = 2 ** 24) -> str:
+    """
+    Calculates the SHA-256 hash of the content of a file, reading it in blocks
+    :param filePath: string, path of the file
+    :param blockSize: int, number of bytes read at a time
+    :return: string, hexadecimal digest
+    """
+
+    contentHash = hashlib.sha256()
+
+    with open(filePath, "rb") as fle:
+        for block in iter(lambda: fle.read(blockSize), b""):
+            contentHash.update(block)
+
+    return contentHash.hexdigest()
+
+
+def getComponentLabels(relabelledImage: np.ndarray, labelImage: np.ndarray) -> np.ndarray:
+    """
+    Returns the label of every connected component of <relabelledImage> in <labelImage>, using a single scatter over
+    the volume
+    :param relabelledImage: numpy.ndarray of ints, connected component labels of <labelImage>
+    (see FarsighOutputConverter.separateMultipleLabels)
+    :param labelImage: numpy.ndarray, label image of the same shape as <relabelledImage>
+    :return: numpy.ndarray of the dtype of <labelImage> and of size relabelledImage.max() + 1, whose element at index
+    <component> is the label of <component> in <labelImage>
+    """
+
+    componentLabels = np.zeros(int(relabelledImage.max()) + 1, dtype=labelImage.dtype)
+    componentLabels[relabelledImage] = labelImage
+
+    return componentLabels
+
+
+class ComponentCache(object):
+
+    def __init__(self, cacheDir: str, labelImageHash: str):
+        """
+        Initializes a persistent cache of the connected components of a farsight output label image and of their
+        shape statistics, stored in a subdirectory of <cacheDir> named after the content hash of the label image
+        (see getFileContentHash)
+        :param cacheDir: string, path of the cache directory
+        :param labelImageHash: string, content hash of the farsight output label image
+        """
+
+        self.cacheDir = os.path.join(cacheDir, labelImageHash)
+
+        self.relabelledImageFile = os.path.join(self.cacheDir, "relabelledImage.npy")
+        self.componentLabelsFile = os.path.join(self.cacheDir, "componentLabels.npy")
+        self.statisticsFile = os.path.join(self.cacheDir, "componentStatistics.pkl")
+
+    def hasComponents(self) -> bool:
+        """
+        Returns whether connected components have been stored in the cache
+        :return: bool
+        """
+
+        return os.path.isfile(self.relabelledImageFile) and os.path.isfile(self.componentLabelsFile)
+
+    def saveComponents(self, relabelledImage: np.ndarray, componentLabels: np.ndarray):
+        """
+        Stores connected components in the cache
+        :param relabelledImage: numpy.ndarray, connected component labels (see FarsighOutputConverter.separateMultipleLabels)
+        :param componentLabels: numpy.ndarray, farsight label of every connected component (see getComponentLabels)
+        """
+
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+        self.saveAtomically(self.componentLabelsFile, lambda fle: np.save(fle, componentLabels))
+        self.saveAtomically(self.relabelledImageFile, lambda fle: np.save(fle, relabelledImage))
+
+    def loadComponents(self) -> (np.ndarray, np.ndarray):
+        """
+        Loads connected components from the cache. The connected component image is memory-mapped copy-on-write, i.e.,
+        it can be modified without changing the cache
+        :return: (relabelledImage, componentLabels), see saveComponents
+        """
+
+        relabelledImage = np.load(self.relabelledImageFile, mmap_mode="c")
+        componentLabels = np.load(self.componentLabelsFile)
+
+        return relabelledImage, componentLabels
+
+    def loadStatistics(self) -> pd.DataFrame:
+        """
+        Loads the shape statistics of connected components stored in the cache
+        :return: pandas.DataFrame indexed by connected component labels, empty if no statistics have been stored
+        """
+
+        if os.path.isfile(self.statisticsFile):
+            return pd.read_pickle(self.statisticsFile)
+        else:
+            return pd.DataFrame()
+
+    def saveStatistics(self, statisticsDF: pd.DataFrame):
+        """
+        Stores shape statistics of connected components in the cache, replacing those stored before
+        :param statisticsDF: pandas.DataFrame indexed by connected component labels
+        """
+
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+        self.saveAtomically(self.statisticsFile, statisticsDF.to_pickle)
+
+    @staticmethod
+    def saveAtomically(filePath: str, saveFunc):
+        """
+        Saves into a temporary file using <saveFunc> and moves it to <filePath>, so that incomplete files are never
+        found at <filePath>
+        :param filePath: string, path of the file
+        :param saveFunc: callable, taking an open binary file as argument
+        """
+
+        tempFilePath = f"{filePath}.tmp"
+
+        with open(tempFilePath, "wb") as fle:
+            saveFunc(fle)
+
+        os.replace(tempFilePath, filePath)
@@ -1,26 +1,154 @@
 import pandas as pd
 import numpy as np
 from skimage import measure
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from FarsightOPConv import tifffile
+from FarsightOPConv.rleLabelVolume import RLELabelVolume
 import logging
 import typing
+import tempfile
+import warnings
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+# number of voxels per slab used when labelling connected components slab by slab without a specified slab size
+DEFAULT_SLAB_VOXELS = 2 ** 24
+
+
+class LabelSeedIndex(object):
+
+    def __init__(self, seedLabels: np.ndarray):
+        """
+        Builds a CSR style inverted index from labels to the indices of the seeds lying on them, using a single stable
+        sort of <seedLabels>. Seed indices of each label are in ascending order.
+        :param seedLabels: numpy.ndarray of ints, label of each seed
+        """
+
+        self.seedIndices = np.argsort(seedLabels, kind="stable")
+
+        sortedSeedLabels = seedLabels[self.seedIndices]
+        self.labels, labelStarts = np.unique(sortedSeedLabels, return_index=True)
+        self.indptr = np.append(labelStarts, sortedSeedLabels.shape[0])
+
+    def getSeedIndices(self, label: int) -> np.ndarray:
+        """
+        Returns the indices of the seeds lying on <label>
+        :param label: int
+        :return: numpy.ndarray of ints, in ascending order. Empty if no seed lies on <label>
+        """
+
+        labelInd = np.searchsorted(self.labels, label)
+
+        if labelInd < self.labels.shape[0] and self.labels[labelInd] == label:
+            return self.seedIndices[self.indptr[labelInd]: self.indptr[labelInd + 1]]
+        else:
+            return self.seedIndices[:0]
+
+    def getFirstSeedIndices(self) -> np.ndarray:
+        """
+        Returns the index of the first seed of every label in self.labels
+        :return: numpy.ndarray of ints, of the same size as self.labels
+        """
+
+        return self.seedIndices[self.indptr[:-1]]
 
 
 class FarsighOutputConverter(object):
 
-    def __init__(self, outputlabelImageFile:str, outputSeedsTXT: str):
+    def __init__(self, outputlabelImageFile:str, outputSeedsTXT: str, lazy: bool = False, cacheSeeds: bool = False,
+                 rle: bool = False):
         """
         Initializes the object by reading in output label image and seeds
         :param outputLabelImageFile: string, path of the output label image file generated by farsight
         :param outputSeedsTXT: string, path of the output seed text file generated by farsight
+        :param lazy: bool, if True, the output label image is not read into memory, but memory-mapped
+        (see readLabelImageLazily)
+        :param cacheSeeds: bool, if True, seeds are read from and stored in a binary sidecar file (see readSeeds)
+        :param rle: bool, if True, the output label image is held run-length encoded (see RLELabelVolume). Seed lookups,
+        bounding boxes, label subsets and crops work directly on the runs. Combined with <lazy>, the label image is
+        encoded a few z-planes at a time and never fully decoded into memory.
         """
 
         self.outputlabelImageFile = outputlabelImageFile
         self.outputSeedsTXT = outputSeedsTXT
 
-        self.seeds = np.loadtxt(self.outputSeedsTXT, dtype=int)
-        self.labelImage = tifffile.imread(self.outputlabelImageFile)
+        self.seeds = readSeeds(self.outputSeedsTXT, useCache=cacheSeeds)
+
+        if lazy:
+            self.labelImage = readLabelImageLazily(self.outputlabelImageFile)
+        else:
+            self.labelImage = tifffile.imread(self.outputlabelImageFile)
+
+        if rle:
+            self.labelImage = RLELabelVolume.fromArray(self.labelImage)
+
+        self.labelBoundingBoxes = None
+        self._labelSeedIndex = None
+
+
+    def getSeedLabels(self) -> np.ndarray:
+        """
+        Gathers the labels of self.labelImage at the positions of all seeds in self.seeds using a single fancy index
+        :return: numpy.ndarray of the same dtype as self.labelImage and of size self.seeds.shape[0]
+        """
+
+        return self.labelImage[self.seeds[:, 2], self.seeds[:, 1], self.seeds[:, 0]]
+
+    @property
+    def labelSeedIndex(self) -> LabelSeedIndex:
+        """
+        Inverted index from the labels of self.labelImage to the indices of the seeds in self.seeds lying on them,
+        built when first accessed and cached thereafter
+        :return: LabelSeedIndex
+        """
+
+        if self._labelSeedIndex is None:
+            self._labelSeedIndex = LabelSeedIndex(self.getSeedLabels())
+
+        return self._labelSeedIndex
+
+    def getLabelSeeds(self, label: int) -> np.ndarray:
+        """
+        Returns the seeds lying on <label>, in the order of self.seeds
+        :param label: int, label of self.labelImage
+        :return: numpy.ndarray of shape (<number of seeds>, 3)
+        """
+
+        return self.seeds[self.labelSeedIndex.getSeedIndices(label)]
+
+    def getLabelBoundingBoxes(self) -> typing.List[typing.Optional[typing.Tuple[slice, ...]]]:
+        """
+        Returns the bounding boxes of all labels in self.labelImage. The bounding boxes are calculated in one pass over
+        self.labelImage using scipy.ndimage.find_objects when this method is first called and are cached thereafter.
+        :return: list, whose element at index <label - 1> is a tuple of slices (z, y, x) indicating the bounding box of
+        <label>, or None if <label> does not occur in self.labelImage
+        """
+
+        if self.labelBoundingBoxes is None:
+            if isinstance(self.labelImage, RLELabelVolume):
+                self.labelBoundingBoxes = self.labelImage.getLabelBoundingBoxes()
+            else:
+                self.labelBoundingBoxes = ndimage.find_objects(self.labelImage)
+
+        return self.labelBoundingBoxes
 
+    def getLabelBoundingBox(self, label: int) -> typing.Optional[typing.Tuple[slice, ...]]:
+        """
+        Returns the bounding box of <label> from the cached bounding box index (see getLabelBoundingBoxes)
+        :param label: int, label of self.labelImage
+        :return: tuple of slices (z, y, x), or None if <label> does not occur in self.labelImage
+        """
+
+        labelBoundingBoxes = self.getLabelBoundingBoxes()
+
+        if 0 < label <= len(labelBoundingBoxes):
+            return labelBoundingBoxes[label - 1]
+        else:
+            return None
 
     def getDesiredLabelsDF(self):
         """
@@ -38,35 +166,50 @@ class FarsighOutputConverter(object):
                   "Farsight Output Label",
                   "Desired Replacement Label"]
 
-        opList = []
-        for ind, (x, y, z) in enumerate(self.seeds):
-
-            currLabel = self.labelImage[z, y, x]
+        seedLabels = self.getSeedLabels()
+        foregroundMask = seedLabels > 0
+        foregroundSeeds = self.seeds[foregroundMask]
 
-            if currLabel > 0:
-                opList.append((x, y, z, currLabel, ind + 1))
+        opData = {opCols[0]: foregroundSeeds[:, 0],
+                  opCols[1]: foregroundSeeds[:, 1],
+                  opCols[2]: foregroundSeeds[:, 2],
+                  opCols[3]: seedLabels[foregroundMask],
+                  opCols[4]: np.flatnonzero(foregroundMask) + 1}
 
-        opDF = pd.DataFrame(data=opList, columns=opCols)
+        opDF = pd.DataFrame(data=opData, columns=opCols)
         return opDF
 
-    def getLabelSeparability(self, currentFarsightLabel: int, outputSeeds: typing.List[int]):
+    def getLabelSeparability(self, currentFarsightLabel: int, outputSeeds: typing.List[int] = None):
         """
         Calculates if the seeds associated with a farsight label are separable, i.e., whether the seeds are part of separable
         connected components.
         :param currentFarsightLabel: int, farsight label
-        :param outputSeeds: list of seeds, where each seed is a 3 member iterable of ints
+        :param outputSeeds: list of seeds, where each seed is a 3 member iterable of ints. If None, the seeds lying on
+        <currentFarsightLabel> are used (see getLabelSeeds)
         :return: (separability, separatedLabel)
         separability: list of bools, having the same size as <outputSeeeds>, indicating the separability of the seeds
         separatedLabel: list of ints, labels assigned to the seeds after separation
         """
 
-        labelMaskImage = np.array(self.labelImage == currentFarsightLabel, dtype=int)
+        boundingBox = self.getLabelBoundingBox(currentFarsightLabel)
+
+        assert boundingBox is not None, f"Label {currentFarsightLabel} not found in label image!"
 
-        assert labelMaskImage.sum() > 0, f"Label {currentFarsightLabel} not found in label image!"
+        if outputSeeds is None:
+            outputSeeds = [tuple(x) for x in self.getLabelSeeds(currentFarsightLabel)]
 
-        separatedLabelImage = measure.label(labelMaskImage, background=0, connectivity=2)
+        labelMaskCrop = self.labelImage[boundingBox] == currentFarsightLabel
 
-        separatedSeedLabels = [separatedLabelImage[z, y, x] for x, y, z in outputSeeds]
+        separatedLabelCrop = measure.label(labelMaskCrop, background=0, connectivity=2)
+
+        # seeds as (z, y, x) relative to the bounding box. Seeds outside the bounding box get the background label 0
+        outputSeedsZYX = np.asarray(outputSeeds, dtype=int).reshape(-1, 3)[:, ::-1]
+        cropSeedsZYX = outputSeedsZYX - [x.start for x in boundingBox]
+        inCropMask = np.logical_and(cropSeedsZYX >= 0, cropSeedsZYX < separatedLabelCrop.shape).all(axis=1)
+
+        separatedSeedLabels = np.zeros(outputSeedsZYX.shape[0], dtype=separatedLabelCrop.dtype)
+        separatedSeedLabels[inCropMask] = separatedLabelCrop[tuple(cropSeedsZYX[inCropMask].T)]
+        separatedSeedLabels = list(separatedSeedLabels)
 
         separationDict = {}
         separability = []
@@ -82,71 +225,588 @@ class FarsighOutputConverter(object):
 
         return separability, separatedSeedLabels
 
-    def separateMultipleLabels(self):
+    def getAllLabelsSeparability(self) -> pd.DataFrame:
+        """
+        Calculates the separability of the seeds of all farsight labels that have seeds, using a single connected
+        component labelling of self.labelImage (see separateMultipleLabels). For every seed lying on a farsight label,
+        the results are identical to those of getLabelSeparability called with the farsight label and all its seeds in
+        the order of self.seeds.
+        :return: pandas.DataFrame with one row per seed lying on a farsight label and the columns "Seed X\n(pixels)",
+        "Seed Y\n(pixels)", "Seed Z\n(pixels)", "Farsight Output Label", "New Label" (label of the connected component
+        in the output of separateMultipleLabels), "Separated Label" (label of the connected component among the
+        connected components of the farsight label, as in getLabelSeparability) and "Separable"
+        """
+
+        relabelledImage, _ = self.separateMultipleLabels()
+
+        seedLabels = self.getSeedLabels()
+        foregroundMask = seedLabels > 0
+        foregroundSeeds = self.seeds[foregroundMask]
+        seedComponents = relabelledImage[foregroundSeeds[:, 2], foregroundSeeds[:, 1], foregroundSeeds[:, 0]]
+
+        # farsight label of every connected component
+        componentLabels = np.zeros(relabelledImage.max() + 1, dtype=self.labelImage.dtype)
+        componentLabels[relabelledImage] = self.labelImage
+
+        # connected components of a farsight label are numbered in the order of their labels in <relabelledImage>,
+        # which is the order of their first voxels, as done by measure.label in getLabelSeparability
+        componentOrder = np.argsort(componentLabels, kind="stable")
+        sortedComponentLabels = componentLabels[componentOrder]
+        labelStarts = np.searchsorted(sortedComponentLabels, sortedComponentLabels, side="left")
+        separatedComponentLabels = np.empty_like(componentOrder)
+        separatedComponentLabels[componentOrder] = np.arange(componentOrder.shape[0]) - labelStarts + 1
+
+        # the first seed of each connected component is separable, later ones are not
+        separability = np.zeros(seedComponents.shape[0], dtype=bool)
+        separability[np.unique(seedComponents, return_index=True)[1]] = True
+
+        opDF = pd.DataFrame()
+        opDF["Seed X\n(pixels)"] = foregroundSeeds[:, 0]
+        opDF["Seed Y\n(pixels)"] = foregroundSeeds[:, 1]
+        opDF["Seed Z\n(pixels)"] = foregroundSeeds[:, 2]
+        opDF["Farsight Output Label"] = seedLabels[foregroundMask]
+        opDF["New Label"] = seedComponents
+        opDF["Separated Label"] = separatedComponentLabels[seedComponents]
+        opDF["Separable"] = separability
+
+        return opDF
+
+    def separateMultipleLabels(self, slabSize: int = None, out: np.ndarray = None, nWorkers: int = 1, dtype=None):
         """
         Identify and separately label connected components in self.labelImage. A connected component here is a set of
         voxels with the same pixel value and laterally or diagonally connected.
+        :param slabSize: int, if specified, connected components are labelled slab by slab, with slabs of <slabSize>
+        z-planes, and written into a memory-mapped array, so that peak memory is bounded by the slab size
+        (see labelConnectedComponentsSlabwise). The result is identical.
+        :param out: numpy.ndarray of the same shape as self.labelImage and of an integer dtype, e.g. a memory-mapped
+        array, into which connected component labels are written. Only used with <slabSize>, <nWorkers> or <dtype>.
+        :param nWorkers: int, number of worker processes labelling slabs in parallel. If larger than 1 and <slabSize>
+        is not specified, self.labelImage is split into <nWorkers> slabs and labels are returned in memory.
+        The result is identical.
+        :param dtype: numpy integer dtype of <relabelledImage>, e.g. numpy.uint32. If specified, labels are written
+        directly into an array of this dtype, slab by slab, without a full size int64 temporary array. If <slabSize> is
+        not specified, slabs of about DEFAULT_SLAB_VOXELS voxels are used. Defaults to int64.
         :return: (relabelledImage, newOldLabelMap)
         relabelledImage: numpy.ndarray of the same size as self.labelImage, with labels changed
         oldLabelnewLabelDict: dict, with old labels as keys and new labels as values. If an old label has no
         corresponding new label, the new label with be none
         """
 
-        relabelledImage = measure.label(self.labelImage, connectivity=2)
+        if slabSize is None and (nWorkers > 1 or dtype is not None):
+            if nWorkers > 1:
+                slabSize = int(np.ceil(self.labelImage.shape[0] / nWorkers))
+            else:
+                slabSize = max(1, DEFAULT_SLAB_VOXELS // int(np.prod(self.labelImage.shape[1:])))
+            if out is None:
+                out = np.empty(self.labelImage.shape, dtype=np.int64 if dtype is None else dtype)
+
+        if slabSize is None:
+            relabelledImage = measure.label(np.asarray(self.labelImage), connectivity=2)
+        else:
+            relabelledImage = labelConnectedComponentsSlabwise(self.labelImage, slabSize, out=out, nWorkers=nWorkers,
+                                                               dtype=np.int64 if dtype is None else dtype)
 
-        newOldLabelMap = {relabelledImage[z, y, x]: self.labelImage[z, y, x] for x, y, z in self.seeds}
+        seedNewLabels = relabelledImage[self.seeds[:, 2], self.seeds[:, 1], self.seeds[:, 0]]
+        newOldLabelMap = dict(zip(seedNewLabels, self.getSeedLabels()))
 
         return relabelledImage, newOldLabelMap
 
-    def getLabelSubsetImage(self, labelSubset: typing.Tuple[int]):
+    def extractSeededComponents(self, out: np.ndarray = None, dtype=np.int64, slabSize: int = None):
+        """
+        Identify and separately label only those connected components of self.labelImage (see separateMultipleLabels)
+        that contain at least one seed. Farsight labels without seeds are treated as background slab by slab, so that
+        their components are not labelled. All components of farsight labels with seeds are labelled, and those without
+        seeds are dropped in the lookup table that merges components across slabs (see
+        labelConnectedComponentsSlabwise), so that no separate removal pass is needed. Components are numbered
+        sequentially from 1 in the order of their first voxels, i.e., the result is identical to the output of
+        separateMultipleLabels with components without seeds removed and the remaining labels renumbered sequentially.
+        Only one slab of self.labelImage is read into memory at a time.
+        :param out: numpy.ndarray of the same shape as self.labelImage and of an integer dtype, e.g. a memory-mapped
+        array, into which the labels are written
+        :param dtype: numpy integer dtype of <relabelledImage> if <out> is None, e.g. numpy.uint32
+        :param slabSize: int, number of z-planes per slab. Defaults to slabs of about DEFAULT_SLAB_VOXELS voxels
+        :return: (relabelledImage, newOldLabelMap)
+        relabelledImage: numpy.ndarray of the same size as self.labelImage, with labels changed
+        newOldLabelMap: dict, with new labels as keys and the corresponding old labels as values
+        """
+
+        if out is None:
+            out = np.empty(self.labelImage.shape, dtype=dtype)
+        else:
+            assert out.shape == self.labelImage.shape, f"Argument out needs to have shape {self.labelImage.shape}"
+
+        if slabSize is None:
+            slabSize = max(1, DEFAULT_SLAB_VOXELS // int(np.prod(self.labelImage.shape[1:])))
+
+        seededLabels = self.labelSeedIndex.labels[self.labelSeedIndex.labels > 0]
+
+        relabelledImage = labelConnectedComponentsSlabwise(self.labelImage, slabSize, out=out,
+                                                           seedsZYX=self.seeds[:, ::-1], labelSubset=seededLabels)
+
+        seedNewLabels = relabelledImage[self.seeds[:, 2], self.seeds[:, 1], self.seeds[:, 0]]
+        newOldLabelMap = dict(zip(seedNewLabels, self.getSeedLabels()))
+
+        return relabelledImage, newOldLabelMap
+
+    def getLabelSubsetImage(self, labelSubset: typing.Tuple[int], inplace: bool = False, out: np.ndarray = None):
         """
         Returns a copy of  self.labelImage> with pixels with labels not in <labelSubset> set to zero.
         A corresponding subset of self.seeds is also formed and returned
 
         :param labelSubset: tuple of ints
+        :param inplace: bool, if True, pixels of self.labelImage with labels not in <labelSubset> are set to zero and
+        self.labelImage is returned instead of a copy. Cached bounding boxes of the removed labels and the cached
+        label seed index are discarded.
+        :param out: numpy.ndarray of the same shape and dtype as self.labelImage, e.g. a preallocated or memory-mapped
+        array, into which the subset label image is written and which is returned. Cannot be used with <inplace>.
         :return: (subsetLabelImage, subsetSeeds)
-        subsetLabelImage: numpy.ndarray of the same shape as labelImage
+        subsetLabelImage: numpy.ndarray of the same shape as labelImage. If self.labelImage is an RLELabelVolume and
+        <out> is not specified, an RLELabelVolume
         subsetSeeds: tuple of numpy.ndarrays of size (3,)
         """
 
-        subsetLabelImage = np.zeros_like(self.labelImage)
+        assert not (inplace and out is not None), "Only one of the arguments inplace and out can be specified"
+
+        if isinstance(self.labelImage, RLELabelVolume):
+
+            subsetLabelImage = self.labelImage.getLabelSubset(labelSubset, inplace=inplace)
+
+            if inplace:
+                self.labelBoundingBoxes = None
+                self._labelSeedIndex = None
+            elif out is not None:
+                assert out.shape == self.labelImage.shape and out.dtype == self.labelImage.dtype, \
+                    f"Argument out needs to have shape {self.labelImage.shape} and dtype {self.labelImage.dtype}"
+                subsetLabelImage = subsetLabelImage.toArray(out=out)
 
-        labelUnique = np.unique(self.labelImage)
-        labelUnique = frozenset(labelUnique[labelUnique != 0])
+            subsetSeedsMask = subsetLabelImage[self.seeds[:, 2], self.seeds[:, 1], self.seeds[:, 0]] > 0
+
+            return subsetLabelImage, tuple(self.seeds[subsetSeedsMask])
+
+        # a single pass over self.labelImage, irrespective of the number of labels in <labelSubset>
+        subsetMask = getLabelMembershipMask(self.labelImage, labelSubset)
+
+        if inplace:
+
+            subsetLabelImage = self.labelImage
+
+            np.logical_not(subsetMask, out=subsetMask)
+            subsetLabelImage[subsetMask] = 0
+
+            if self.labelBoundingBoxes is not None:
+                labelSubsetSet = frozenset(labelSubset)
+                self.labelBoundingBoxes = [boundingBox if ind + 1 in labelSubsetSet else None
+                                           for ind, boundingBox in enumerate(self.labelBoundingBoxes)]
+
+            self._labelSeedIndex = None
+
+        else:
+
+            if out is None:
+                subsetLabelImage = np.zeros_like(self.labelImage)
+            else:
+                assert out.shape == self.labelImage.shape and out.dtype == self.labelImage.dtype, \
+                    f"Argument out needs to have shape {self.labelImage.shape} and dtype {self.labelImage.dtype}"
+                subsetLabelImage = out
+                subsetLabelImage[...] = 0
 
-        for label in labelSubset:
-            if label in labelUnique:
-                subsetLabelImage[self.labelImage == label] = label
+            np.copyto(subsetLabelImage, self.labelImage, where=subsetMask)
 
-        subsetSeeds = tuple(x for x in self.seeds if subsetLabelImage[x[2], x[1], x[0]] > 0)
+        subsetSeedsMask = subsetLabelImage[self.seeds[:, 2], self.seeds[:, 1], self.seeds[:, 0]] > 0
+        subsetSeeds = tuple(self.seeds[subsetSeedsMask])
 
         return subsetLabelImage, subsetSeeds
 
 
-def replaceLabels(image: np.ndarray, labels2Replace:typing.Iterable, replaceValue, makeGenerator=False) -> np.ndarray:
+def readSeeds(seedsTXT: str, useCache: bool = False) -> np.ndarray:
+    """
+    Reads a seed text file generated by farsight, with one seed per line given as whitespace separated integers
+    "X Y Z", using numpy.loadtxt or, with numpy older than 1.23, the C parser of pandas.read_csv. Comment lines
+    starting with "#" are skipped.
+    If <useCache> is True, the seeds are read from the sidecar file "<seedsTXT>.seedCache.npz" if it was created from a
+    seed text file with the current size and modification time of <seedsTXT>. Otherwise the seed text file is parsed and
+    the sidecar file is (re)created.
+    :param seedsTXT: string, path of the seed text file
+    :param useCache: bool, whether to use the sidecar file
+    :return: numpy.ndarray of dtype int and shape (<number of seeds>, 3)
+    """
+
+    if useCache:
+        seedsTXTStat = os.stat(seedsTXT)
+        cacheFile = f"{seedsTXT}.seedCache.npz"
+        if os.path.isfile(cacheFile):
+            with np.load(cacheFile) as cache:
+                if cache["seedsTXTSize"] == seedsTXTStat.st_size and \
+                        cache["seedsTXTMTime"] == seedsTXTStat.st_mtime_ns:
+                    return cache["seeds"]
+
+    # numpy.loadtxt is implemented in C from numpy 1.23 on, before which pandas.read_csv is faster. Both skip lines
+    # starting with "#"
+    if np.lib.NumpyVersion(np.__version__) >= "1.23.0":
+        with warnings.catch_warnings():
+            # warning about empty seed files
+            warnings.simplefilter("ignore", UserWarning)
+            seeds = np.loadtxt(seedsTXT, dtype=int, ndmin=2)
+    else:
+        try:
+            seeds = pd.read_csv(seedsTXT, sep=r"\s+", header=None, comment="#", dtype=int).values
+        except pd.errors.EmptyDataError:
+            seeds = np.zeros((0, 3), dtype=int)
+
+    if seeds.size == 0:
+        seeds = np.zeros((0, 3), dtype=int)
+
+    assert seeds.shape[1] == 3, f"Seeds in {seedsTXT} do not consist of three integers each"
+
+    if useCache:
+        try:
+            np.savez(cacheFile, seeds=seeds,
+                     seedsTXTSize=seedsTXTStat.st_size, seedsTXTMTime=seedsTXTStat.st_mtime_ns)
+        except OSError as e:
+            logging.warning(f"Could not write seed cache file {cacheFile}: {e}")
+
+    return seeds
+
+
+def getTemporaryMemmap(shape: typing.Tuple[int, ...], dtype) -> np.memmap:
+    """
+    Creates and returns a zero initialized memory-mapped array backed by an anonymous temporary file, which is removed
+    when the array is no longer referenced
+    :param shape: tuple of ints, shape of the array
+    :param dtype: numpy dtype of the array
+    :return: numpy.memmap
+    """
+
+    # the memory map keeps its own file descriptor, so the file object can be closed
+    with tempfile.TemporaryFile() as fle:
+        return np.memmap(fle, dtype=dtype, mode="w+", shape=shape)
+
+
+def readLabelImageLazily(labelImageFile: str) -> np.memmap:
+    """
+    Memory-maps the image data of the first series of a TIFF file without reading it into memory. Image data that is
+    not memory-mappable, e.g. compressed image data, is decoded page by page into a temporary memory-mapped array
+    (see getTemporaryMemmap), so that at most one page is held in memory at any time.
+    The returned array is copy-on-write, i.e., changes made to it are never written to <labelImageFile>.
+    :param labelImageFile: string, path of a TIFF file
+    :return: numpy.memmap
+    """
+
+    try:
+        return tifffile.memmap(labelImageFile, mode="c")
+    except ValueError:
+        with tifffile.TiffFile(labelImageFile) as tif:
+            series = tif.series[0]
+            labelImage = getTemporaryMemmap(series.shape, series.dtype)
+            labelImagePages = labelImage.reshape((len(series.pages), -1))
+            for pageInd, page in enumerate(series.pages):
+                labelImagePages[pageInd] = page.asarray().ravel()
+
+        return labelImage
+
+
+def getSlabBoundaryLabelPairs(lowerImagePlane: np.ndarray, upperImagePlane: np.ndarray,
+                              lowerLabelPlane: np.ndarray, upperLabelPlane: np.ndarray,
+                              connectivity: int = 2) -> (np.ndarray, np.ndarray):
+    """
+    Finds pairs of connected component labels that are connected across the boundary between two adjacent z-planes,
+    i.e., pairs of neighbouring voxels with the same, non-zero pixel value
+    :param lowerImagePlane: numpy.ndarray, image z-plane below the boundary
+    :param upperImagePlane: numpy.ndarray, image z-plane above the boundary
+    :param lowerLabelPlane: numpy.ndarray, connected component labels of <lowerImagePlane>
+    :param upperLabelPlane: numpy.ndarray, connected component labels of <upperImagePlane>
+    :param connectivity: int, connectivity as defined by skimage.measure.label
+    :return: (lowerLabels, upperLabels), numpy.ndarrays of labels of the same size, where lowerLabels[i] is connected to
+    upperLabels[i]
+    """
+
+    lowerLabels = []
+    upperLabels = []
+
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+
+            # voxels of the two planes differ in z and in all non-zero in-plane offsets
+            if 1 + abs(dy) + abs(dx) > connectivity:
+                continue
+
+            lowerSlices = (slice(max(0, -dy), lowerImagePlane.shape[0] - max(0, dy)),
+                           slice(max(0, -dx), lowerImagePlane.shape[1] - max(0, dx)))
+            upperSlices = (slice(max(0, dy), upperImagePlane.shape[0] - max(0, -dy)),
+                           slice(max(0, dx), upperImagePlane.shape[1] - max(0, -dx)))
+
+            lowerImageValues = lowerImagePlane[lowerSlices]
+            connectedMask = np.logical_and(lowerImageValues == upperImagePlane[upperSlices], lowerImageValues != 0)
+
+            lowerLabels.append(lowerLabelPlane[lowerSlices][connectedMask])
+            upperLabels.append(upperLabelPlane[upperSlices][connectedMask])
+
+    return np.concatenate(lowerLabels), np.concatenate(upperLabels)
+
+
+def getMergedLabelLUT(nLabels: int, labelPairs: typing.Iterable[typing.Tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+    """
+    Merges the labels 1 to <nLabels> that are connected through <labelPairs>, using connected components of the graph
+    with labels as nodes and pairs as edges (a vectorized union-find). Merged labels are numbered sequentially in the
+    order of their smallest constituent label.
+    :param nLabels: int, number of labels
+    :param labelPairs: iterable of tuples of two equally sized numpy.ndarrays of labels that are connected
+    :return: numpy.ndarray of size <nLabels> + 1, lookup table from labels to merged labels, with 0 mapped to 0
+    """
+
+    labelPairs = list(labelPairs)
+    rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [x for x, _ in labelPairs])
+    cols = np.concatenate([np.zeros(0, dtype=np.int64)] + [y for _, y in labelPairs])
+
+    graph = coo_matrix((np.ones(rows.shape[0], dtype=np.int8), (rows, cols)), shape=(nLabels + 1, nLabels + 1))
+    nGraphComponents, graphComponents = connected_components(graph, directed=False)
+
+    # graph components of labels, i.e. excluding that of 0, in the order of their first, i.e. smallest, label
+    labelGraphComponents, firstLabelIndices = np.unique(graphComponents[1:], return_index=True)
+    labelGraphComponents = labelGraphComponents[np.argsort(firstLabelIndices)]
+
+    mergedLabels = np.zeros(nGraphComponents, dtype=np.int64)
+    mergedLabels[labelGraphComponents] = np.arange(1, labelGraphComponents.shape[0] + 1)
+
+    mergedLabelLUT = np.zeros(nLabels + 1, dtype=np.int64)
+    mergedLabelLUT[1:] = mergedLabels[graphComponents[1:]]
+
+    return mergedLabelLUT
+
+
+def _labelSharedImageSlab(sharedMemoryName: str, shape: typing.Tuple[int, ...], dtype, slabStart: int, slabEnd: int,
+                          connectivity: int) -> np.ndarray:
+    """
+    Worker function of labelConnectedComponentsSlabwise, labelling connected components of a slab of an image held in
+    shared memory
+    :param sharedMemoryName: string, name of the multiprocessing.shared_memory.SharedMemory block holding the image
+    :param shape: tuple of ints, shape of the image
+    :param dtype: numpy dtype of the image
+    :param slabStart: int, first z-plane of the slab
+    :param slabEnd: int, one more than the last z-plane of the slab
+    :param connectivity: int, connectivity as defined by skimage.measure.label
+    :return: numpy.ndarray, connected component labels of the slab
+    """
+
+    sharedMemory = shared_memory.SharedMemory(name=sharedMemoryName)
+    try:
+        image = np.ndarray(shape, dtype=dtype, buffer=sharedMemory.buf)
+        slabLabels = measure.label(image[slabStart: slabEnd], connectivity=connectivity)
+        del image
+    finally:
+        sharedMemory.close()
+
+    return slabLabels
+
+
+def getLabelSubsetSlab(image: np.ndarray, slabStart: int, slabEnd: int, labelSubset: np.ndarray = None) -> np.ndarray:
+    """
+    Reads the slab of z-planes <slabStart> to <slabEnd> of an image into memory, with pixels whose values are not in
+    <labelSubset> set to zero
+    :param image: numpy.ndarray or RLELabelVolume, 3D image, can be a memory-mapped array
+    :param slabStart: int, first z-plane of the slab
+    :param slabEnd: int, z-plane after the last z-plane of the slab
+    :param labelSubset: numpy.ndarray of labels. If None, the slab is returned unchanged
+    :return: numpy.ndarray
+    """
+
+    slab = np.asarray(image[slabStart: slabEnd])
+
+    if labelSubset is None:
+        return slab
+    else:
+        return slab * getLabelMembershipMask(slab, labelSubset).astype(slab.dtype)
+
+
+def labelConnectedComponentsSlabwise(image: np.ndarray, slabSize: int, out: np.ndarray = None,
+                                     connectivity: int = 2, nWorkers: int = 1, dtype=np.int64,
+                                     seedsZYX: np.ndarray = None, labelSubset: np.ndarray = None) -> np.ndarray:
+    """
+    Labels connected components of voxels with the same, non-zero pixel value of a 3D image, one slab of <slabSize>
+    z-planes at a time. The slabs are labelled independently using skimage.measure.label, components connected across
+    slab boundaries are merged (see getSlabBoundaryLabelPairs and getMergedLabelLUT) and the labels are renumbered, so
+    that the result is identical to that of skimage.measure.label(image, connectivity=connectivity).
+    With a single worker, only one slab of <image> and of the output is held in memory at any time. With more workers,
+    <image> is copied into shared memory and slabs are labelled in parallel in a pool of processes.
+    :param image: numpy.ndarray, 3D input image, can be a memory-mapped array
+    :param slabSize: int, number of z-planes per slab
+    :param out: numpy.ndarray of the same shape as <image> and of an integer dtype, into which the labels are written.
+    If None, a temporary memory-mapped array of dtype <dtype> is used (see getTemporaryMemmap)
+    :param connectivity: int, connectivity as defined by skimage.measure.label
+    :param nWorkers: int, number of worker processes
+    :param dtype: numpy integer dtype of the temporary memory-mapped array used if <out> is None. Only slab sized
+    temporary arrays of dtype int64 are created, unless the dtype of the output cannot hold the number of voxels of
+    <image>, in which case labels of slabs are stored in a temporary memory-mapped array of a wider dtype before the
+    slabs are merged, so that only the number of merged labels needs to fit into the output dtype.
+    :param seedsZYX: numpy.ndarray of ints and of shape (<number of seeds>, 3), voxel positions in numpy order. If
+    specified, only components containing at least one of these voxels are labelled, numbered sequentially in the order
+    of their labels, and other voxels are set to zero. This is done in the lookup table merging the slabs, without an
+    additional pass.
+    :param labelSubset: numpy.ndarray of labels. If specified, voxels of <image> whose values are not in <labelSubset>
+    are treated as background, slab by slab (see getLabelSubsetSlab), without a masked copy of <image>
+    :return: numpy.ndarray, <out> or the temporary memory-mapped array
+    """
+
+    assert image.ndim == 3, "Argument image needs to be a 3D image"
+    assert slabSize > 0, "Argument slabSize needs to be positive"
+    assert nWorkers > 0, "Argument nWorkers needs to be positive"
+
+    if out is None:
+        out = getTemporaryMemmap(image.shape, dtype)
+    else:
+        assert out.shape == image.shape, f"Argument out needs to have shape {image.shape}"
+
+    maxOutLabel = np.iinfo(out.dtype).max
+
+    # the number of labels of slabs is at most the number of voxels
+    if maxOutLabel >= image.size:
+        slabwiseLabels = out
+    else:
+        slabwiseLabels = getTemporaryMemmap(image.shape, np.min_scalar_type(image.size))
+
+    slabStarts = list(range(0, image.shape[0], slabSize))
+    slabEnds = slabStarts[1:] + [image.shape[0]]
+
+    sharedMemory = None
+    executor = None
+    try:
+
+        if nWorkers == 1:
+            slabLabelsIterator = (measure.label(getLabelSubsetSlab(image, slabStart, slabEnd, labelSubset),
+                                                connectivity=connectivity)
+                                  for slabStart, slabEnd in zip(slabStarts, slabEnds))
+        else:
+            sharedMemory = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+            sharedImage = np.ndarray(image.shape, dtype=image.dtype, buffer=sharedMemory.buf)
+            for slabStart, slabEnd in zip(slabStarts, slabEnds):
+                sharedImage[slabStart: slabEnd] = getLabelSubsetSlab(image, slabStart, slabEnd, labelSubset)
+            del sharedImage
+
+            executor = ProcessPoolExecutor(max_workers=nWorkers)
+            slabLabelsIterator = executor.map(_labelSharedImageSlab,
+                                              *zip(*[(sharedMemory.name, image.shape, image.dtype, slabStart, slabEnd,
+                                                      connectivity)
+                                                     for slabStart, slabEnd in zip(slabStarts, slabEnds)]))
+
+        nLabels = 0
+        for slabStart, slabLabels in zip(slabStarts, slabLabelsIterator):
+
+            nSlabLabels = slabLabels.max()
+            np.add(slabLabels, nLabels, out=slabLabels, where=slabLabels > 0)
+            slabwiseLabels[slabStart: slabStart + slabLabels.shape[0]] = slabLabels
+
+            nLabels += int(nSlabLabels)
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if sharedMemory is not None:
+            sharedMemory.close()
+            sharedMemory.unlink()
+
+    labelPairs = (getSlabBoundaryLabelPairs(*getLabelSubsetSlab(image, z - 1, z + 1, labelSubset),
+                                            slabwiseLabels[z - 1], slabwiseLabels[z], connectivity=connectivity)
+                  for z in slabStarts[1:])
+    mergedLabelLUT = getMergedLabelLUT(nLabels, labelPairs)
+
+    if seedsZYX is not None:
+        seedMergedLabels = np.unique(mergedLabelLUT[slabwiseLabels[tuple(np.asarray(seedsZYX).T)]])
+        seedMergedLabels = seedMergedLabels[seedMergedLabels > 0]
+        retainedLabelLUT = np.zeros(int(mergedLabelLUT.max(initial=0)) + 1, dtype=np.int64)
+        retainedLabelLUT[seedMergedLabels] = np.arange(1, seedMergedLabels.shape[0] + 1)
+        mergedLabelLUT = retainedLabelLUT[mergedLabelLUT]
+
+    assert mergedLabelLUT.max(initial=0) <= maxOutLabel, f"Number of labels exceeds the range of {out.dtype}"
+    mergedLabelLUT = mergedLabelLUT.astype(out.dtype)
+
+    for slabStart, slabEnd in zip(slabStarts, slabEnds):
+        out[slabStart: slabEnd] = mergedLabelLUT[slabwiseLabels[slabStart: slabEnd]]
+
+    return out
+
+
+def getLabelMembershipMask(image: np.ndarray, labels: typing.Iterable, maxLUTSize: int = 2 ** 24) -> np.ndarray:
+    """
+    Returns a boolean mask indicating the pixels of <image> whose values are in <labels>. For integer images whose
+    values lie in [0, <maxLUTSize>), the mask is formed in one pass using a dense boolean lookup table indexed by the
+    pixel values. The lookup table covers the whole value range for 8bit and 16bit unsigned images and [0, image.max()]
+    otherwise. For images with negative or very large values, numpy.isin is used instead.
+    :param image: np.ndarray or RLELabelVolume, input image
+    :param labels: iterable of labels
+    :param maxLUTSize: int, maximum number of entries of the lookup table
+    :return: np.ndarray of dtype bool and the same shape as <image>
+    """
+
+    if isinstance(image, RLELabelVolume):
+        return image.getLabelMembershipMask(labels)
+
+    labels = np.asarray(list(labels))
+
+    lutSize = None
+    if image.dtype.kind == "u" and image.dtype.itemsize <= 2:
+        lutSize = 2 ** (8 * image.dtype.itemsize)
+    elif image.dtype.kind in "ui" and image.size > 0:
+        imageMin, imageMax = image.min(), image.max()
+        if imageMin >= 0 and imageMax < maxLUTSize:
+            lutSize = int(imageMax) + 1
+
+    if lutSize is None:
+        return np.isin(image, labels)
+
+    labelsInRange = labels[np.logical_and(labels >= 0, labels < lutSize)].astype(np.intp)
+    labelLUT = np.zeros(lutSize, dtype=bool)
+    labelLUT[labelsInRange] = True
+
+    return labelLUT[image]
+
+
+def replaceLabels(image: np.ndarray, labels2Replace:typing.Iterable, replaceValue, makeGenerator=False,
+                  inplace: bool = False, out: np.ndarray = None) -> np.ndarray:
     """
     Replaces the values of pixels in <labels2Replace> with replaceValue
-    :param image: np.ndarray, input image
-    :param toReplace: iterable of labels, of the type image.dtype
+    :param image: np.ndarray or RLELabelVolume, input image
+    :param labels2Replace: iterable of labels, of the type image.dtype
     :param replaceValue: value of type image.dtype
-    :return: np.ndarray
+    :param makeGenerator: bool, if True, a generator yielding the output image is returned
+    :param inplace: bool, if True, <image> is modified and returned instead of a copy
+    :param out: np.ndarray of the same shape and dtype as <image>, e.g. a preallocated or memory-mapped array, into
+    which the output image is written and which is returned. Cannot be used with <inplace>.
+    :return: np.ndarray, or RLELabelVolume if <image> is an RLELabelVolume and <out> is not specified
     """
 
-    imageCopy = image.copy()
+    assert not (inplace and out is not None), "Only one of the arguments inplace and out can be specified"
+
+    labels2Replace = tuple(labels2Replace)
 
     assert all(type(x) == image.dtype for x in labels2Replace), \
-        f"All elements of labels2Replace are not of type {image.dype}"
+        f"All elements of labels2Replace are not of type {image.dtype}"
+
+    if isinstance(image, RLELabelVolume):
+
+        imageCopy = image.replaceLabels(labels2Replace, replaceValue, inplace=inplace)
 
+        if out is not None:
+            assert out.shape == image.shape and out.dtype == image.dtype, \
+                f"Argument out needs to have shape {image.shape} and dtype {image.dtype}"
+            imageCopy = imageCopy.toArray(out=out)
 
-    labels2ReplaceFrozenSet = frozenset(labels2Replace)
-    maskFuncVectorized = np.vectorize(lambda x: x in labels2ReplaceFrozenSet)
+        return (x for x in (imageCopy,)) if makeGenerator else imageCopy
+
+    toRemoveMask = getLabelMembershipMask(image, labels2Replace)
+
+    if inplace:
+        imageCopy = image
+    elif out is not None:
+        assert out.shape == image.shape and out.dtype == image.dtype, \
+            f"Argument out needs to have shape {image.shape} and dtype {image.dtype}"
+        imageCopy = out
+        np.copyto(imageCopy, image)
+    else:
+        imageCopy = image.copy()
 
-    toRemoveMask = maskFuncVectorized(image)
     imageCopy[toRemoveMask] = replaceValue
 
     if makeGenerator:
-        yield imageCopy
+        return (x for x in (imageCopy,))
     else:
         return imageCopy
-
-
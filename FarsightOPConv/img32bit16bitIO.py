@@ -1,55 +1,651 @@
 import numpy as np
 import typing
+import itertools
 import pandas as pd
+import pathlib as pl
+from scipy.sparse import coo_matrix
+from FarsightOPConv import tifffile
 
-def labelConv32bitTo16bit(img32: np.ndarray) -> (typing.List[np.ndarray], pd.DataFrame):
+
+# number of voxels processed at a time
+DEFAULT_CHUNK_VOXELS = 2 ** 20
+
+# ways of packing 32bit labels into 16bit images, see labelConv32bitTo16bit
+PACKINGS = ("sequential", "coloured", "compact")
+
+
+def labelConv32bitTo16bit(img32: np.ndarray, cropToLabels: bool = False, packing: str = "sequential",
+                          outFile: str = None) -> (typing.List[np.ndarray], pd.DataFrame):
     """
     Converts a 32bit image to a set of 16bit images of least possible size and returns a mapping between labels of
-    input and output images
+    input and output images. The input image is read once, in chunks of DEFAULT_CHUNK_VOXELS voxels: the output image
+    index and output label of every non-zero voxel are calculated arithmetically and scattered into the output images,
+    which are allocated as higher labels are encountered.
     :param img32: np.ndarray of dtype np.uint32, input 32bit image
-    :return: (img16List, LabelMapDF)
-    img16List: list of np.ndarray objects of dtype np.uint16, list of output 16bit images
+    :param cropToLabels: bool, if True, each output image is cropped to the bounding box of its labels, which are
+    determined in a first pass over <img32> (see getLabelPresenceAndBoundingBoxes), and the offsets of the output images
+    are returned as well
+    :param packing: str, one of
+    1. "sequential": every label gets its own output label, i.e., label l is mapped to label (l - 1) % 65535 + 1 of the
+    output image with index (l - 1) // 65535
+    2. "coloured": labels that do not touch each other, even diagonally, can share an output label of the same output
+    image (see getLabelColours), so that usually one or two output images suffice. Every input label is then a
+    connected component of its output label, with full connectivity. This needs an additional pass over <img32>.
+    3. "compact": labels are relabelled sequentially before being packed sequentially (see getSequentialLabelMaps), so
+    that the minimum number of output images, ceil(<number of labels> / 65535), is used. This needs an additional pass
+    over <img32>, but no relabelled copy of it.
+    :param outFile: str, path of a ".npy" or ".tif"/".tiff" file. If specified, the output images are written into a
+    memory-mapped stack of shape (<number of output images>,) + img32.shape stored in this file (see createImg16Stack),
+    instead of being held in memory, and can later be read one at a time (see loadImg16Stack). The number of output
+    images is determined before the decomposition, which for sequential packing needs an additional pass over <img32>.
+    Cannot be used with <cropToLabels>.
+    :return: (img16List, LabelMapDF) or, if <cropToLabels> is True, (img16List, LabelMapDF, offsets)
+    img16List: list of np.ndarray objects of dtype np.uint16, list of output 16bit images, memory-mapped views of the
+    stack if <outFile> is specified
     LabelMapDF: pandas.DataFrame, with the columns "Input Label", "Output Image index", "Output Label"
+    offsets: list of tuples of ints (z, y, x), position of the first voxel of each output image in <img32>
     """
 
-    assert type(img32) is np.ndarray, "Argument img32 needs to be of type numpy.ndarray"
+    assert isinstance(img32, np.ndarray), "Argument img32 needs to be of type numpy.ndarray"
     assert img32.dtype == np.uint32, "Argument img32 needs to have dtype numpy.uint32"
 
-    maxLabel = img32.max()
+    assert packing in PACKINGS, f"Unknown packing {packing}"
+
+    assert not (cropToLabels and outFile is not None), \
+        "Only one of the arguments cropToLabels and outFile can be specified"
+
     nLabelsImg16 = 2 ** 16 - 1
-    nOutImages = int(np.ceil(maxLabel / nLabelsImg16))
 
-    labelMapDF = pd.DataFrame()
     img16List = []
 
-    ipLabels = np.unique(img32)
-    ipLabels = ipLabels[ipLabels != 0]
+    if cropToLabels:
+
+        labelMapDFs = []
+        offsets = []
+        for outImageInd, img16, labelMapChunkDF, offset in iterLabelConv32bitTo16bit(img32, cropToLabels=True,
+                                                                                     packing=packing):
+            img16List.append(img16)
+            labelMapDFs.append(labelMapChunkDF)
+            offsets.append(offset)
+
+        if labelMapDFs:
+            labelMapDF = pd.concat(labelMapDFs).sort_values(by="Input Label")
+        else:
+            labelMapDF = getLabelMapDF(np.zeros(1, dtype=bool))
+
+        return img16List, labelMapDF, offsets
+
+    else:
+
+        img16FlatList = []
+
+        labelPresence, labelColours = getPackingLabelColours(img32, packing)
+
+        # with sequential packing, the labels present are determined during the decomposition
+        updatePresence = labelPresence is None
+        if updatePresence:
+            # labelPresence[label] is True if <label> occurs in <img32>
+            labelPresence = np.zeros(1, dtype=bool)
+
+        img16Stack = None
+        if outFile is not None:
+            if updatePresence:
+                nImages = -(-int(img32.max(initial=0)) // nLabelsImg16)
+            else:
+                labels = np.flatnonzero(labelPresence[1:]) + 1
+                nImages = int(getOutImageIndsAndLabels(labels, nLabelsImg16, labelColours)[0].max(initial=-1)) + 1
+            img16Stack = createImg16Stack(outFile, nImages, img32.shape)
+            img16List = list(img16Stack)
+            img16FlatList = [img16.reshape(-1) for img16 in img16List]
+
+        for chunkVoxelInds, chunkLabels in iterNonZeroVoxels(img32):
+
+            if updatePresence:
+                labelPresence = updateLabelPresence(labelPresence, chunkLabels, int(chunkLabels.max()))
+
+            outImageInds, outLabels = getOutImageIndsAndLabels(chunkLabels, nLabelsImg16, labelColours)
+
+            chunkMinOutImageInd = int(outImageInds.min())
+            chunkMaxOutImageInd = int(outImageInds.max())
+
+            while len(img16List) <= chunkMaxOutImageInd:
+                img16List.append(np.zeros(img32.shape, dtype=np.uint16))
+                img16FlatList.append(img16List[-1].reshape(-1))
+
+            if chunkMinOutImageInd == chunkMaxOutImageInd:
+                img16FlatList[chunkMaxOutImageInd][chunkVoxelInds] = outLabels
+            else:
+                for outImageInd in np.flatnonzero(np.bincount(outImageInds)):
+                    outImageMask = outImageInds == outImageInd
+                    img16FlatList[outImageInd][chunkVoxelInds[outImageMask]] = outLabels[outImageMask]
+
+        if img16Stack is not None:
+            img16Stack.flush()
+
+    return img16List, getLabelMapDF(labelPresence, nLabelsImg16, labelColours)
+
+
+def createImg16Stack(outFile: str, nImages: int, shape: typing.Tuple[int, ...]) -> np.memmap:
+    """
+    Creates a memory-mapped stack of zero-valued 16bit images in a file
+    :param outFile: str, path of the file, either a ".npy" file (see numpy.lib.format.open_memmap) or a ".tif"/".tiff"
+    file, which is stored uncompressed (see tifffile.memmap). An existing file is overwritten
+    :param nImages: int, number of images
+    :param shape: tuple of ints, shape of each image
+    :return: np.memmap of dtype np.uint16 and of shape (<nImages>,) + <shape>
+    """
+
+    stackShape = (nImages,) + tuple(shape)
+    suffix = pl.Path(outFile).suffix.lower()
+
+    if suffix == ".npy":
+        return np.lib.format.open_memmap(outFile, mode="w+", dtype=np.uint16, shape=stackShape)
+    elif suffix in (".tif", ".tiff"):
+        return tifffile.memmap(outFile, shape=stackShape, dtype=np.uint16)
+    else:
+        raise ValueError(f"Unknown format of file {outFile}, needs to be one of .npy, .tif, .tiff")
+
+
+def loadImg16Stack(stackFile: str, mode: str = "r") -> np.memmap:
+    """
+    Memory-maps a stack of 16bit images created with createImg16Stack, e.g. by labelConv32bitTo16bit, so that only the
+    images accessed are read
+    :param stackFile: str, path of a ".npy" or ".tif"/".tiff" file
+    :param mode: str, "r", "r+" or "c", see numpy.memmap
+    :return: np.memmap of dtype np.uint16 and of shape (<number of images>, ...)
+    """
+
+    suffix = pl.Path(stackFile).suffix.lower()
+
+    if suffix == ".npy":
+        return np.load(stackFile, mmap_mode=mode)
+    elif suffix in (".tif", ".tiff"):
+        return tifffile.memmap(stackFile, mode=mode)
+    else:
+        raise ValueError(f"Unknown format of file {stackFile}, needs to be one of .npy, .tif, .tiff")
+
+
+def labelConv16bitTo32bit(imgs16: typing.Iterable[np.ndarray], labelMapDF: pd.DataFrame, out: np.ndarray = None,
+                          shape: typing.Tuple[int, ...] = None,
+                          offsets: typing.Iterable[typing.Tuple[int, ...]] = None) -> np.ndarray:
+    """
+    Merges 16bit images into a 32bit image using a label map, i.e., the inverse of labelConv32bitTo16bit with
+    sequential or compact packing. For each 16bit image, a lookup table from its output labels to input labels is
+    created and applied in slabs of about DEFAULT_CHUNK_VOXELS voxels, so that images can be streamed
+    :param imgs16: list or iterator of np.ndarray objects of dtype np.uint16, the 16bit images in the order of their
+    output image indices
+    :param labelMapDF: pandas.DataFrame, with the columns "Input Label", "Output Image index", "Output Label"
+    (see labelConv32bitTo16bit)
+    :param out: np.ndarray of dtype np.uint32, e.g. a memory-mapped array, into which the 32bit image is written. It is
+    set to zero before the merge
+    :param shape: tuple of ints, shape of the 32bit image, required if <out> is not specified and <offsets> are
+    :param offsets: iterable of tuples of ints, positions of the first voxels of the 16bit images in the 32bit image,
+    for 16bit images cropped to their labels (see labelConv32bitTo16bit)
+    :return: np.ndarray of dtype np.uint32, <out> if specified
+    """
+
+    nLabelsImg16 = 2 ** 16 - 1
+
+    outImageInds = labelMapDF["Output Image Index"].values.astype(np.int64)
+    outLabels = labelMapDF["Output Label"].values.astype(np.int64)
+    inputLabels = labelMapDF["Input Label"].values.astype(np.uint32)
+
+    assert np.unique(outImageInds * (nLabelsImg16 + 1) + outLabels).shape[0] == outLabels.shape[0], \
+        "Output labels of labelMapDF are not unique within output images, e.g., due to coloured packing"
+
+    imgs16 = iter(imgs16)
+    offsets = None if offsets is None else iter(offsets)
+
+    if out is None:
+        if shape is None:
+            assert offsets is None, "Argument shape needs to be specified with offsets"
+            firstImg16 = next(imgs16, None)
+            assert firstImg16 is not None, "Argument shape needs to be specified if there are no 16bit images"
+            shape = firstImg16.shape
+            imgs16 = itertools.chain([firstImg16], imgs16)
+        out = np.zeros(shape, dtype=np.uint32)
+    else:
+        assert out.dtype == np.uint32, "Argument out needs to have dtype numpy.uint32"
+        out[...] = 0
+
+    for outImageInd, img16 in enumerate(imgs16):
+
+        labelLUT = np.zeros(nLabelsImg16 + 1, dtype=np.uint32)
+        outImageMask = outImageInds == outImageInd
+        labelLUT[outLabels[outImageMask]] = inputLabels[outImageMask]
+
+        if offsets is None:
+            assert img16.shape == out.shape, f"16bit images need to have shape {out.shape}"
+            outCrop = out
+        else:
+            offset = next(offsets)
+            outCrop = out[tuple(slice(x, x + y) for x, y in zip(offset, img16.shape))]
+            assert outCrop.shape == img16.shape, f"16bit image {outImageInd} does not fit into shape {out.shape}"
+
+        slabSize = max(1, DEFAULT_CHUNK_VOXELS * img16.shape[0] // max(img16.size, 1))
+
+        for slabStart in range(0, img16.shape[0], slabSize):
+
+            img16Slab = np.asarray(img16[slabStart: slabStart + slabSize])
+            np.copyto(outCrop[slabStart: slabStart + slabSize], labelLUT[img16Slab], where=img16Slab > 0)
+
+    return out
+
+
+def iterLabelConv32bitTo16bit(img32: np.ndarray, cropToLabels: bool = False, packing: str = "sequential"):
+    """
+    Generator variant of labelConv32bitTo16bit, creating one 16bit image at a time, so that only one 16bit image needs
+    to be held in memory. After a first pass over <img32> to determine the labels present (and the bounding boxes of
+    output images if <cropToLabels>), each 16bit image is created in a pass over (its bounding box in) <img32>
+    (see getIntegerShiftWindowFunc and mapLabelColours)
+    :param img32: np.ndarray of dtype np.uint32, input 32bit image
+    :param cropToLabels: bool, if True, each output image is cropped to the bounding box of its labels and its offset
+    is yielded as well
+    :param packing: str, "sequential", "coloured" or "compact", see labelConv32bitTo16bit
+    :return: generator of tuples (outImageInd, img16, labelMapChunkDF) or, if <cropToLabels> is True,
+    (outImageInd, img16, labelMapChunkDF, offset)
+    outImageInd: int, index of the output image
+    img16: np.ndarray of dtype np.uint16, output image
+    labelMapChunkDF: pandas.DataFrame, rows of the label map (see labelConv32bitTo16bit) of the labels of <img16>,
+    sorted by input labels, and, with sequential or compact packing, by output labels
+    offset: tuple of ints (z, y, x), position of the first voxel of <img16> in <img32>
+    """
+
+    assert isinstance(img32, np.ndarray), "Argument img32 needs to be of type numpy.ndarray"
+    assert img32.dtype == np.uint32, "Argument img32 needs to have dtype numpy.uint32"
+
+    assert packing in PACKINGS, f"Unknown packing {packing}"
+
+    nLabelsImg16 = 2 ** 16 - 1
+
+    labelPresence, labelColours = getPackingLabelColours(img32, packing)
+
+    if cropToLabels:
+        labelPresence, boundingBoxes = getLabelPresenceAndBoundingBoxes(img32, nLabelsImg16, labelColours)
+    elif labelPresence is None:
+        labelPresence = getLabelPresence(img32)
+
+    labelMapDF = getLabelMapDF(labelPresence, nLabelsImg16, labelColours)
+    labelMapOutImageInds = labelMapDF["Output Image Index"].values
+
+    if not cropToLabels:
+        nOutImages = int(labelMapOutImageInds.max()) + 1 if labelMapOutImageInds.shape[0] else 0
+        boundingBoxes = [(slice(None),) * img32.ndim] * nOutImages
+
+    for outImageInd, boundingBox in enumerate(boundingBoxes):
+
+        img32Crop = img32[boundingBox]
+        img16 = np.empty(img32Crop.shape, dtype=np.uint16)
+
+        if labelColours is None:
+            labelMapFunc, ipEnd = getIntegerShiftWindowFunc(nLabelsImg16, 1 + outImageInd * nLabelsImg16, 1)
+            labelMapFunc(img32Crop, out=img16)
+        else:
+            mapLabelColours(img32Crop, labelColours, outImageInd, nLabelsImg16, out=img16)
+
+        labelMapChunkDF = labelMapDF[labelMapOutImageInds == outImageInd]
+
+        if cropToLabels:
+            yield outImageInd, img16, labelMapChunkDF, tuple(x.start for x in boundingBox)
+        else:
+            yield outImageInd, img16, labelMapChunkDF
+
+
+def getLabelMapDF(labelPresence: np.ndarray, nLabelsImg16: int = 2 ** 16 - 1,
+                  labelColours: np.ndarray = None) -> pd.DataFrame:
+    """
+    Calculates the label map of labelConv32bitTo16bit arithmetically from the sorted input labels
+    :param labelPresence: np.ndarray of dtype bool, whose element at index <label> is True if <label> occurs in the input
+    image
+    :param nLabelsImg16: int, number of labels per output image
+    :param labelColours: np.ndarray of ints, see getOutImageIndsAndLabels
+    :return: pandas.DataFrame, with the columns "Input Label", "Output Image index", "Output Label"
+    """
+
+    ipLabels = np.flatnonzero(labelPresence[1:]).astype(np.uint32) + np.uint32(1)
+    outImageInds, outLabels = getOutImageIndsAndLabels(ipLabels, nLabelsImg16, labelColours)
+
+    return pd.DataFrame({"Input Label": ipLabels,
+                         "Output Image Index": outImageInds.astype(np.int64),
+                         "Output Label": outLabels})
+
+
+def getPackingLabelColours(img32: np.ndarray, packing: str) -> (np.ndarray, np.ndarray):
+    """
+    Determines the colours of labels for a packing (see labelConv32bitTo16bit and getOutImageIndsAndLabels), which for
+    coloured and compact packing requires a pass over <img32>
+    :param img32: np.ndarray, input image
+    :param packing: str, one of PACKINGS
+    :return: (labelPresence, labelColours)
+    labelPresence: np.ndarray of dtype bool, see getLabelPresence, or None for sequential packing
+    labelColours: np.ndarray of ints, see getOutImageIndsAndLabels, or None for sequential packing
+    """
+
+    if packing == "coloured":
+        labelPresence, labelPairs = getLabelPresenceAndAdjacency(img32)
+        return labelPresence, getLabelColours(labelPresence, labelPairs)
+    elif packing == "compact":
+        labelPresence = getLabelPresence(img32)
+        return labelPresence, getSequentialLabelMaps(labelPresence)[0].astype(np.int64) - 1
+    else:
+        return None, None
+
+
+def getSequentialLabelMaps(labelPresence: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Calculates the maps between labels and sequential labels, i.e., labels 1, 2, ..., <number of labels>, assigned in
+    the order of the labels
+    :param labelPresence: np.ndarray of dtype bool, whose element at index <label> is True if <label> occurs
+    :return: (forwardMap, inverseMap)
+    forwardMap: np.ndarray of dtype np.uint32 and of the shape of <labelPresence>, whose element at index <label> is the
+    sequential label of <label>, or 0 if <label> does not occur or is 0
+    inverseMap: np.ndarray of dtype np.uint32 and of size <number of labels> + 1, whose element at index
+    <sequential label> is the corresponding label, with 0 at index 0
+    """
+
+    labelPresence = labelPresence.copy()
+    labelPresence[0] = False
+
+    forwardMap = np.cumsum(labelPresence, dtype=np.uint32)
+    forwardMap[~labelPresence] = 0
+
+    inverseMap = np.zeros(int(forwardMap.max(initial=0)) + 1, dtype=np.uint32)
+    inverseMap[1:] = np.flatnonzero(labelPresence)
+
+    return forwardMap, inverseMap
+
+
+def relabelSequential(img32: np.ndarray, out: np.ndarray = None) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Relabels an image sequentially, i.e., with labels 1, 2, ..., <number of labels>, keeping the order of labels, in a
+    pass to determine the labels present and a lookup table pass, both in chunks of DEFAULT_CHUNK_VOXELS voxels
+    :param img32: np.ndarray of non-negative ints, input image
+    :param out: np.ndarray of the shape of <img32> and of an unsigned integer dtype, e.g. a memory-mapped array, into
+    which the relabelled image is written. Can be <img32> to relabel in place. If None, an array of the dtype of <img32>
+    is created
+    :return: (relabelled, forwardMap, inverseMap)
+    relabelled: np.ndarray, relabelled image, <out> if specified
+    forwardMap, inverseMap: see getSequentialLabelMaps
+    """
+
+    forwardMap, inverseMap = getSequentialLabelMaps(getLabelPresence(img32))
+
+    if out is None:
+        out = np.empty(img32.shape, dtype=img32.dtype)
+    else:
+        assert out.shape == img32.shape, f"Argument out needs to have shape {img32.shape}"
+        assert inverseMap.shape[0] - 1 <= np.iinfo(out.dtype).max, f"Number of labels exceeds the range of {out.dtype}"
+
+    slabSize = max(1, DEFAULT_CHUNK_VOXELS * img32.shape[0] // max(img32.size, 1))
+
+    for slabStart in range(0, img32.shape[0], slabSize):
+        np.copyto(out[slabStart: slabStart + slabSize], forwardMap[img32[slabStart: slabStart + slabSize]],
+                  casting="unsafe")
+
+    return out, forwardMap, inverseMap
+
+
+def getOutImageIndsAndLabels(labels: np.ndarray, nLabelsImg16: int, labelColours: np.ndarray = None) \
+        -> (np.ndarray, np.ndarray):
+    """
+    Maps non-zero input labels to output image indices and output labels. The colour c of a label is mapped to the
+    label c % <nLabelsImg16> + 1 of the output image with index c // <nLabelsImg16>.
+    :param labels: np.ndarray of positive ints
+    :param nLabelsImg16: int, number of labels per output image
+    :param labelColours: np.ndarray of ints, whose element at index <label> is the colour of <label> (see
+    getLabelColours). If None, the colour of label l is l - 1, i.e., labels are packed sequentially
+    :return: (outImageInds, outLabels)
+    outImageInds: np.ndarray of ints
+    outLabels: np.ndarray of dtype np.uint16
+    """
+
+    colours = labels - 1 if labelColours is None else labelColours[labels]
+    outImageInds, outLabels = np.divmod(colours, nLabelsImg16)
+
+    return outImageInds, outLabels.astype(np.uint16) + np.uint16(1)
+
+
+def mapLabelColours(img32: np.ndarray, labelColours: np.ndarray, outImageInd: int, nLabelsImg16: int,
+                    out: np.ndarray = None) -> np.ndarray:
+    """
+    Creates the output image with index <outImageInd> of coloured packing (see getOutImageIndsAndLabels), in slabs
+    along the first axis of about DEFAULT_CHUNK_VOXELS voxels
+    :param img32: np.ndarray of ints, input image, can be a non-contiguous view
+    :param labelColours: np.ndarray of ints, see getOutImageIndsAndLabels, with a negative colour at index 0
+    :param outImageInd: int, index of the output image
+    :param nLabelsImg16: int, number of labels per output image
+    :param out: np.ndarray of dtype np.uint16 and the shape of <img32>, into which the output image is written
+    :return: np.ndarray of dtype np.uint16, <out> if specified
+    """
+
+    if out is None:
+        out = np.empty(img32.shape, dtype=np.uint16)
+    else:
+        assert out.shape == img32.shape, f"Argument out needs to have shape {img32.shape}"
+
+    slabSize = max(1, DEFAULT_CHUNK_VOXELS * img32.shape[0] // max(img32.size, 1))
+
+    for slabStart in range(0, img32.shape[0], slabSize):
+
+        slabOutImageInds, slabOutLabels = np.divmod(labelColours[img32[slabStart: slabStart + slabSize]],
+                                                    nLabelsImg16)
+        slabOutLabels += 1
+        np.multiply(slabOutLabels, slabOutImageInds == outImageInd, out=slabOutLabels)
+        np.copyto(out[slabStart: slabStart + slabSize], slabOutLabels, casting="unsafe")
+
+    return out
+
+
+def getLabelPresenceAndAdjacency(img32: np.ndarray, slabSize: int = None) -> (np.ndarray, np.ndarray):
+    """
+    Determines in one pass over <img32> the labels present in it and the pairs of labels touching each other with full
+    connectivity, i.e., through faces, edges or corners of voxels in 3D. Neighbouring voxels are compared along the
+    half of the neighbourhood offsets, slab by slab, with slabs of <slabSize> z-planes overlapping by one z-plane.
+    :param img32: np.ndarray of non-negative ints, input image
+    :param slabSize: int, number of z-planes per slab. If None, slabs of about DEFAULT_CHUNK_VOXELS voxels are used
+    :return: (labelPresence, labelPairs)
+    labelPresence: np.ndarray of dtype bool, whose element at index <label> is True if <label> occurs in <img32>
+    labelPairs: np.ndarray of shape (<number of pairs>, 2) and of the dtype of <img32>, unique pairs of touching
+    non-zero labels, with the smaller label first
+    """
+
+    if slabSize is None:
+        slabSize = max(1, DEFAULT_CHUNK_VOXELS // max(int(np.prod(img32.shape[1:])), 1))
+
+    # neighbourhood offsets lexicographically larger than (0, ..., 0)
+    offsets = [offset for offset in np.ndindex(*(3,) * img32.ndim)
+               if tuple(x - 1 for x in offset) > (0,) * img32.ndim]
+    offsets = [tuple(x - 1 for x in offset) for offset in offsets]
+
+    labelPresence = np.zeros(1, dtype=bool)
+    pairKeys = []
+
+    for slabStart in range(0, img32.shape[0], slabSize):
+
+        slabPairKeys = []
+
+        slabEnd = min(slabStart + slabSize, img32.shape[0])
+        # one more z-plane to compare the last z-plane of the slab with the first z-plane of the next slab
+        slab = np.asarray(img32[slabStart: min(slabEnd + 1, img32.shape[0])])
+        nSlabPlanes = slabEnd - slabStart
+
+        slabLabels = slab[:nSlabPlanes][slab[:nSlabPlanes] > 0]
+        if slabLabels.shape[0]:
+            labelPresence = updateLabelPresence(labelPresence, slabLabels, int(slabLabels.max()))
+
+        for offset in offsets:
+
+            # voxels of this slab and their neighbours at <offset>
+            voxelSlices = [slice(0, nSlabPlanes - (1 if offset[0] and slab.shape[0] == nSlabPlanes else 0))]
+            neighbourSlices = [slice(offset[0], voxelSlices[0].stop + offset[0])]
+            for d, s in zip(offset[1:], slab.shape[1:]):
+                voxelSlices.append(slice(max(0, -d), s - max(0, d)))
+                neighbourSlices.append(slice(max(0, d), s - max(0, -d)))
+
+            voxels = slab[tuple(voxelSlices)]
+            neighbours = slab[tuple(neighbourSlices)]
+
+            touching = voxels != neighbours
+            np.logical_and(touching, voxels > 0, out=touching)
+            np.logical_and(touching, neighbours > 0, out=touching)
+
+            touchingVoxels = voxels[touching].astype(np.uint64)
+            touchingNeighbours = neighbours[touching].astype(np.uint64)
+
+            slabPairKeys.append((np.minimum(touchingVoxels, touchingNeighbours) << np.uint64(32))
+                                | np.maximum(touchingVoxels, touchingNeighbours))
+
+        pairKeys.append(np.unique(np.concatenate(slabPairKeys)))
+
+    pairKeys = np.unique(np.concatenate(pairKeys)) if pairKeys else np.zeros(0, dtype=np.uint64)
+    labelPairs = np.stack([pairKeys >> np.uint64(32), pairKeys & np.uint64(2 ** 32 - 1)], axis=1).astype(img32.dtype)
+
+    return labelPresence, labelPairs
+
+
+def getLabelColours(labelPresence: np.ndarray, labelPairs: np.ndarray) -> np.ndarray:
+    """
+    Colours the graph of touching labels greedily, visiting labels in the order of decreasing number of touching labels
+    (Welsh-Powell), so that touching labels have different colours and few colours are used
+    :param labelPresence: np.ndarray of dtype bool, see getLabelPresenceAndAdjacency
+    :param labelPairs: np.ndarray of shape (<number of pairs>, 2), see getLabelPresenceAndAdjacency
+    :return: np.ndarray of dtype np.int64 and of the shape of <labelPresence>, whose element at index <label> is the
+    colour of <label>, i.e., a non-negative int, or -1 if <label> is 0 or does not occur
+    """
+
+    nLabels = labelPresence.shape[0]
+    labelPairs = labelPairs.astype(np.int64)
 
-    for outImageInd in range(nOutImages):
+    adjacency = coo_matrix((np.ones(2 * labelPairs.shape[0], dtype=bool),
+                            (np.concatenate((labelPairs[:, 0], labelPairs[:, 1])),
+                             np.concatenate((labelPairs[:, 1], labelPairs[:, 0])))),
+                           shape=(nLabels, nLabels)).tocsr()
+    indptr = adjacency.indptr.tolist()
+    indices = adjacency.indices.tolist()
 
-        # print(f"Doing image {outImageInd + 1}")
-        opStart = 1
-        ipStart = 1 + outImageInd * nLabelsImg16
+    labels = np.flatnonzero(labelPresence[1:]) + 1
+    labelOrder = labels[np.argsort(-np.diff(adjacency.indptr)[labels], kind="stable")]
 
-        labelMapFunc, ipEnd = getIntegerShiftWindowFunc(nLabelsImg16, ipStart, opStart)
+    colours = [-1] * nLabels
+    for label in labelOrder.tolist():
+        neighbourColours = {colours[x] for x in indices[indptr[label]: indptr[label + 1]]}
+        colour = 0
+        while colour in neighbourColours:
+            colour += 1
+        colours[label] = colour
 
-        outImage32 = labelMapFunc(img32)
+    return np.array(colours, dtype=np.int64)
 
-        assert np.logical_and(outImage32 >= 0, outImage32 < 2**16).all(), \
-            "There is a problem with tranlating image pixel values to 16bit"
 
-        outImage16 = outImage32.astype(np.uint16)
+def iterNonZeroVoxels(img32: np.ndarray):
+    """
+    Iterates over the non-zero voxels of an image, in chunks of DEFAULT_CHUNK_VOXELS voxels
+    :param img32: np.ndarray, input image
+    :return: generator of tuples (chunkVoxelInds, chunkLabels)
+    chunkVoxelInds: np.ndarray of ints, indices of non-zero voxels in the flattened <img32>
+    chunkLabels: np.ndarray of the dtype of <img32>, values of the non-zero voxels
+    """
+
+    img32Flat = img32.reshape(-1)
+
+    for chunkStart in range(0, img32Flat.shape[0], DEFAULT_CHUNK_VOXELS):
+
+        chunk = img32Flat[chunkStart: chunkStart + DEFAULT_CHUNK_VOXELS]
+        chunkVoxelInds = np.flatnonzero(chunk)
+
+        if chunkVoxelInds.shape[0]:
+            yield chunkVoxelInds + chunkStart, chunk[chunkVoxelInds]
+
+
+def getLabelPresence(img32: np.ndarray) -> np.ndarray:
+    """
+    Determines the labels present in an image in one pass
+    :param img32: np.ndarray of non-negative ints, input image
+    :return: np.ndarray of dtype bool and of size <maximum label> + 1, whose element at index <label> is True if
+    <label> occurs in <img32>. The element at index 0 is False.
+    """
+
+    labelPresence = np.zeros(1, dtype=bool)
+
+    for chunkVoxelInds, chunkLabels in iterNonZeroVoxels(img32):
+        labelPresence = updateLabelPresence(labelPresence, chunkLabels, int(chunkLabels.max()))
+
+    return labelPresence
+
+
+def updateLabelPresence(labelPresence: np.ndarray, labels: np.ndarray, maxLabel: int) -> np.ndarray:
+    """
+    Marks <labels> as present in the boolean bitmap <labelPresence>, growing it if required
+    :param labelPresence: np.ndarray of dtype bool
+    :param labels: np.ndarray of non-negative ints
+    :param maxLabel: int, maximum of <labels>
+    :return: np.ndarray of dtype bool, <labelPresence> or its grown copy
+    """
+
+    if maxLabel >= labelPresence.shape[0]:
+        labelPresence = np.concatenate((labelPresence, np.zeros(maxLabel + 1 - labelPresence.shape[0], dtype=bool)))
+
+    labelPresence[labels] = True
+
+    return labelPresence
+
+
+def getLabelPresenceAndBoundingBoxes(img32: np.ndarray, nLabelsImg16: int = 2 ** 16 - 1,
+                                     labelColours: np.ndarray = None) \
+        -> (np.ndarray, typing.List[typing.Tuple[slice, ...]]):
+    """
+    Determines in one pass over <img32> the labels present in it and the bounding boxes of the labels of each output
+    image of labelConv32bitTo16bit, e.g., with sequential packing, of the labels in
+    [1 + i * <nLabelsImg16>, (i + 1) * <nLabelsImg16>] for the output image with index i
+    :param img32: np.ndarray, input image
+    :param nLabelsImg16: int, number of labels per output image
+    :param labelColours: np.ndarray of ints, see getOutImageIndsAndLabels
+    :return: (labelPresence, boundingBoxes)
+    labelPresence: np.ndarray of dtype bool, whose element at index <label> is True if <label> occurs in <img32>
+    boundingBoxes: list of tuples of slices, one per output image. Output images without labels have a bounding box
+    containing only the first voxel of <img32>.
+    """
+
+    labelPresence = np.zeros(1, dtype=bool)
+    boxStarts = np.zeros((0, img32.ndim), dtype=np.int64)
+    boxEnds = np.zeros((0, img32.ndim), dtype=np.int64)
+
+    for chunkVoxelInds, chunkLabels in iterNonZeroVoxels(img32):
+
+        labelPresence = updateLabelPresence(labelPresence, chunkLabels, int(chunkLabels.max()))
+
+        outImageInds = getOutImageIndsAndLabels(chunkLabels, nLabelsImg16, labelColours)[0]
+
+        nOutImages = int(outImageInds.max()) + 1
+        if nOutImages > boxStarts.shape[0]:
+            nNewBoxes = nOutImages - boxStarts.shape[0]
+            boxStarts = np.concatenate((boxStarts, np.full((nNewBoxes, img32.ndim), np.iinfo(np.int64).max)))
+            boxEnds = np.concatenate((boxEnds, np.zeros((nNewBoxes, img32.ndim), dtype=np.int64)))
 
-        img16List.append(outImage16)
+        voxelCoords = np.unravel_index(chunkVoxelInds, img32.shape)
 
-        currentLabelMap = pd.DataFrame()
-        currentRetainedIPLabels = ipLabels[np.logical_and(ipLabels >= ipStart, ipLabels <= ipEnd)]
-        currentLabelMap["Input Label"] = currentRetainedIPLabels
-        currentLabelMap["Output Image Index"] = outImageInd
-        currentLabelMap["Output Label"] = labelMapFunc(currentRetainedIPLabels)
-        labelMapDF = labelMapDF.append(currentLabelMap, ignore_index=True)
+        chunkOutImageInds = np.flatnonzero(np.bincount(outImageInds))
 
-    return img16List, labelMapDF
+        for outImageInd in chunkOutImageInds:
+
+            if chunkOutImageInds.shape[0] > 1:
+                outImageMask = outImageInds == outImageInd
+                outImageVoxelCoords = [x[outImageMask] for x in voxelCoords]
+            else:
+                outImageVoxelCoords = voxelCoords
+
+            for axis, axisCoords in enumerate(outImageVoxelCoords):
+                boxStarts[outImageInd, axis] = min(boxStarts[outImageInd, axis], axisCoords.min())
+                boxEnds[outImageInd, axis] = max(boxEnds[outImageInd, axis], axisCoords.max() + 1)
+
+    emptyBoxes = boxEnds.max(axis=1) == 0
+    boxStarts[emptyBoxes] = 0
+    boxEnds[emptyBoxes] = 1
+
+    boundingBoxes = [tuple(slice(start, end) for start, end in zip(boxStart, boxEnd))
+                     for boxStart, boxEnd in zip(boxStarts.tolist(), boxEnds.tolist())]
+
+    return labelPresence, boundingBoxes
 
 
 def getIntegerShiftWindowFunc(nLabels2Retain: int, inputStart: int, outputStart: int) -> (typing.Callable, int):
@@ -57,6 +653,11 @@ def getIntegerShiftWindowFunc(nLabels2Retain: int, inputStart: int, outputStart:
     Creates an returns a vectorized function that sequentially applies the following to its input:
     (i) subtraction of (<inputStart> - <outputStart>) and
     (ii) setting all values outside [<outputStart>, <outputStart> + nLabels2Retain -1]
+    The created function takes an integer array <x> and an optional argument <out>, an integer array of the shape of
+    <x>, e.g. a preallocated numpy.uint16 buffer, into which the output is written and which is returned.
+    If <out> is None, an array of dtype numpy.uint16 is created if the output fits into 16 bits and of numpy.int64
+    otherwise. The input, which may be a non-contiguous view, is processed in slabs along its first axis of about
+    DEFAULT_CHUNK_VOXELS elements without full size temporary arrays.
     :param nLabels2Retain: int, number of labels to retain
     :param inputStart: int, lowest integer that is to be retained in the input of created function
     :param outputStart: int, lowest integer in the output of created function
@@ -65,12 +666,43 @@ def getIntegerShiftWindowFunc(nLabels2Retain: int, inputStart: int, outputStart:
     ipLast: Maximum value in the input of <vecF> that is retained
     """
 
-    def f(x):
-        y = x - (inputStart - outputStart)
-        y = y if outputStart <= y <= outputStart + nLabels2Retain - 1 else 0
-        return y
-
     ipLast = inputStart + nLabels2Retain - 1
+    shift = inputStart - outputStart
+    outDtype = np.uint16 if outputStart + nLabels2Retain - 1 < 2 ** 16 else np.int64
+
+    def vecF(x, out: np.ndarray = None) -> np.ndarray:
+
+        x = np.asarray(x)
+
+        if out is None:
+            out = np.empty(x.shape, dtype=outDtype)
+        else:
+            assert out.shape == x.shape, f"Argument out needs to have shape {x.shape}"
+
+        if x.ndim == 0:
+            vecF(x[None], out=out[None])
+            return out
+
+        # values in the window are shifted in the dtype of <x> without leaving its range, values outside the window may
+        # wrap around, but are masked
+        shiftX = np.asarray(abs(shift)).astype(x.dtype)
+        shiftFunc = np.subtract if shift >= 0 else np.add
+
+        slabSize = max(1, DEFAULT_CHUNK_VOXELS * x.shape[0] // max(x.size, 1))
+
+        for slabStart in range(0, x.shape[0], slabSize):
+
+            xSlab = x[slabStart: slabStart + slabSize]
+
+            inWindow = xSlab >= inputStart
+            np.logical_and(inWindow, xSlab <= ipLast, out=inWindow)
+
+            with np.errstate(over="ignore"):
+                shiftedSlab = shiftFunc(xSlab, shiftX)
+
+            np.multiply(shiftedSlab, inWindow, out=shiftedSlab)
+            np.copyto(out[slabStart: slabStart + slabSize], shiftedSlab, casting="unsafe")
 
-    return np.vectorize(f), ipLast
+        return out
 
+    return vecF, ipLast
@@ -0,0 +1,359 @@
+import numpy as np
+import typing
+
+
+# maximum number of voxels processed at a time when encoding and decoding
+DEFAULT_CHUNK_VOXELS = 2 ** 22
+
+
+class RLELabelVolume(object):
+
+    def __init__(self, shape: typing.Tuple[int, int, int], dtype, runStarts: np.ndarray, runLengths: np.ndarray,
+                 runValues: np.ndarray):
+        """
+        Initializes a 3D label volume stored as runs of constant, non-zero values along X. Voxels not covered by any
+        run are background (0). Runs never extend across rows, are sorted by their start and do not overlap.
+        Usually created using RLELabelVolume.fromArray
+        :param shape: tuple of 3 ints, (z, y, x) shape of the volume
+        :param dtype: numpy dtype of the volume
+        :param runStarts: numpy.ndarray of ints, index of the first voxel of each run in the flattened volume
+        :param runLengths: numpy.ndarray of ints, number of voxels of each run
+        :param runValues: numpy.ndarray of dtype <dtype>, value of each run
+        """
+
+        assert len(shape) == 3, "Argument shape needs to have 3 elements"
+        assert runStarts.shape == runLengths.shape == runValues.shape, \
+            "Arguments runStarts, runLengths and runValues need to have the same shape"
+
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(dtype)
+        self.runStarts = np.asarray(runStarts, dtype=np.int64)
+        self.runLengths = np.asarray(runLengths, dtype=np.int64)
+        self.runValues = np.asarray(runValues, dtype=self.dtype)
+
+    @classmethod
+    def fromArray(cls, image: np.ndarray, chunkVoxels: int = DEFAULT_CHUNK_VOXELS) -> "RLELabelVolume":
+        """
+        Encodes a 3D label image, a few z-planes at a time, so that only chunk sized temporary arrays are created
+        :param image: numpy.ndarray, 3D label image, can be a memory-mapped array
+        :param chunkVoxels: int, approximate number of voxels encoded at a time
+        :return: RLELabelVolume
+        """
+
+        assert image.ndim == 3, "Argument image needs to be a 3D image"
+
+        nPlaneVoxels = image.shape[1] * image.shape[2]
+        chunkSize = max(1, chunkVoxels // max(nPlaneVoxels, 1))
+
+        runStarts, runLengths, runValues = [], [], []
+        for chunkStart in range(0, image.shape[0], chunkSize):
+
+            chunkFlat = np.asarray(image[chunkStart: chunkStart + chunkSize]).reshape(-1)
+
+            # a run starts wherever the value changes and at the start of every row
+            isRunStart = np.empty(chunkFlat.shape[0], dtype=bool)
+            isRunStart[0] = True
+            np.not_equal(chunkFlat[1:], chunkFlat[:-1], out=isRunStart[1:])
+            isRunStart[::image.shape[2]] = True
+
+            chunkRunStarts = np.flatnonzero(isRunStart)
+            chunkRunLengths = np.diff(np.concatenate((chunkRunStarts, [chunkFlat.shape[0]])))
+            chunkRunValues = chunkFlat[chunkRunStarts]
+
+            foregroundRuns = chunkRunValues != 0
+            runStarts.append(chunkRunStarts[foregroundRuns] + chunkStart * nPlaneVoxels)
+            runLengths.append(chunkRunLengths[foregroundRuns])
+            runValues.append(chunkRunValues[foregroundRuns])
+
+        if len(runStarts) == 0:
+            return cls(image.shape, image.dtype, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                       np.zeros(0, dtype=image.dtype))
+
+        return cls(image.shape, image.dtype, np.concatenate(runStarts), np.concatenate(runLengths),
+                   np.concatenate(runValues))
+
+    @property
+    def ndim(self) -> int:
+        return 3
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Number of bytes of the decoded volume, as numpy.ndarray.nbytes
+        :return: int
+        """
+
+        return self.size * self.dtype.itemsize
+
+    @property
+    def runsNBytes(self) -> int:
+        """
+        Number of bytes used by the runs
+        :return: int
+        """
+
+        return self.runStarts.nbytes + self.runLengths.nbytes + self.runValues.nbytes
+
+    def copy(self) -> "RLELabelVolume":
+
+        return RLELabelVolume(self.shape, self.dtype, self.runStarts.copy(), self.runLengths.copy(),
+                              self.runValues.copy())
+
+    def max(self):
+
+        return self.runValues.max() if self.runValues.shape[0] else self.dtype.type(0)
+
+    def getLabels(self) -> np.ndarray:
+        """
+        Returns the sorted, unique non-zero labels of the volume
+        :return: numpy.ndarray of dtype self.dtype
+        """
+
+        return np.unique(self.runValues)
+
+    def toArray(self, out: np.ndarray = None, chunkVoxels: int = DEFAULT_CHUNK_VOXELS) -> np.ndarray:
+        """
+        Decodes the volume
+        :param out: numpy.ndarray of shape self.shape, C-contiguous, e.g. a memory-mapped array, into which the volume
+        is written and which is returned
+        :param chunkVoxels: int, approximate number of foreground voxels decoded at a time
+        :return: numpy.ndarray of shape self.shape and dtype self.dtype, or <out>
+        """
+
+        if out is None:
+            out = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            assert out.shape == self.shape, f"Argument out needs to have shape {self.shape}"
+            assert out.flags.c_contiguous, "Argument out needs to be C-contiguous"
+            out[...] = 0
+
+        writeRuns(out.reshape(-1), self.runStarts, self.runLengths, self.runValues, chunkVoxels=chunkVoxels)
+
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+
+        array = self.toArray()
+
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def _getRunZYX(self, runInds=slice(None)) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Returns the z, y and x coordinates of the first voxels of runs
+        :param runInds: index into the runs
+        :return: (z, y, x), numpy.ndarrays of ints
+        """
+
+        rows, x = np.divmod(self.runStarts[runInds], self.shape[2])
+        z, y = np.divmod(rows, self.shape[1])
+
+        return z, y, x
+
+    def getValuesAt(self, z: np.ndarray, y: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """
+        Looks up the values at voxel positions using a binary search over the runs
+        :param z: numpy.ndarray of ints, z coordinates
+        :param y: numpy.ndarray of ints, y coordinates
+        :param x: numpy.ndarray of ints, x coordinates
+        :return: numpy.ndarray of dtype self.dtype and of the shape of <z>
+        """
+
+        flatInds = np.ravel_multi_index((np.asarray(z), np.asarray(y), np.asarray(x)), self.shape)
+
+        runInds = np.searchsorted(self.runStarts, flatInds, side="right") - 1
+        inRun = runInds >= 0
+        inRun[inRun] = flatInds[inRun] < self.runStarts[runInds[inRun]] + self.runLengths[runInds[inRun]]
+
+        values = np.zeros(flatInds.shape, dtype=self.dtype)
+        values[inRun] = self.runValues[runInds[inRun]]
+
+        return values
+
+    def getCrop(self, boundingBox: typing.Tuple[slice, slice, slice]) -> np.ndarray:
+        """
+        Decodes a box of the volume, touching only the runs of the z-planes of the box
+        :param boundingBox: tuple of 3 slices (z, y, x), with steps None or 1
+        :return: numpy.ndarray of dtype self.dtype
+        """
+
+        (z0, z1), (y0, y1), (x0, x1) = [sl.indices(s)[:2] for sl, s in zip(boundingBox, self.shape)]
+        z1, y1, x1 = max(z0, z1), max(y0, y1), max(x0, x1)
+
+        crop = np.zeros((z1 - z0, y1 - y0, x1 - x0), dtype=self.dtype)
+
+        nPlaneVoxels = self.shape[1] * self.shape[2]
+        firstRun, lastRun = np.searchsorted(self.runStarts, [z0 * nPlaneVoxels, z1 * nPlaneVoxels])
+        runInds = slice(firstRun, lastRun)
+
+        z, y, runX0 = self._getRunZYX(runInds)
+        runX1 = runX0 + self.runLengths[runInds]
+        cropX0 = np.maximum(runX0, x0)
+        cropX1 = np.minimum(runX1, x1)
+
+        inCrop = np.logical_and(np.logical_and(y >= y0, y < y1), cropX1 > cropX0)
+
+        cropRunStarts = ((z[inCrop] - z0) * crop.shape[1] + y[inCrop] - y0) * crop.shape[2] + cropX0[inCrop] - x0
+        writeRuns(crop.reshape(-1), cropRunStarts, (cropX1 - cropX0)[inCrop], self.runValues[runInds][inCrop])
+
+        return crop
+
+    def __getitem__(self, key):
+        """
+        Supports indexing with a tuple of 3 integer arrays, as in self.getValuesAt, and basic indexing with ints and
+        slices, as in self.getCrop
+        """
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) == 3 and all(isinstance(x, (np.ndarray, list)) for x in key):
+            return self.getValuesAt(*key)
+
+        assert len(key) <= 3, "Too many indices for a 3D volume"
+
+        boundingBox = []
+        squeezeAxes = []
+        for axis, (sl, s) in enumerate(zip(key + (slice(None),) * (3 - len(key)), self.shape)):
+
+            if isinstance(sl, slice):
+                assert sl.step in (None, 1), "Only slices with step 1 are supported"
+                boundingBox.append(sl)
+            else:
+                ind = int(sl)
+                if not -s <= ind < s:
+                    raise IndexError(f"index {ind} is out of bounds for axis {axis} with size {s}")
+                ind = ind % s
+                boundingBox.append(slice(ind, ind + 1))
+                squeezeAxes.append(axis)
+
+        crop = self.getCrop(tuple(boundingBox))
+
+        return crop.squeeze(axis=tuple(squeezeAxes)) if squeezeAxes else crop
+
+    def getLabelBoundingBoxes(self) -> typing.List[typing.Optional[typing.Tuple[slice, ...]]]:
+        """
+        Returns the bounding boxes of all labels, calculated from the runs, in the format of scipy.ndimage.find_objects
+        :return: list of length self.max(), whose element at index <label> - 1 is a tuple of slices (z, y, x) bounding
+        <label>, or None if <label> does not occur in the volume
+        """
+
+        boundingBoxes = [None] * int(self.max())
+
+        if self.runValues.shape[0] == 0:
+            return boundingBoxes
+
+        runOrder = np.argsort(self.runValues, kind="stable")
+        sortedRunValues = self.runValues[runOrder]
+        labelStarts = np.flatnonzero(np.concatenate(([True], sortedRunValues[1:] != sortedRunValues[:-1])))
+        labels = sortedRunValues[labelStarts]
+
+        z, y, x0 = self._getRunZYX(runOrder)
+        x1 = x0 + self.runLengths[runOrder]
+
+        boxStarts = [np.minimum.reduceat(c, labelStarts) for c in (z, y, x0)]
+        boxEnds = [np.maximum.reduceat(c, labelStarts) + d for c, d in ((z, 1), (y, 1), (x1, 0))]
+
+        for label, boxStart, boxEnd in zip(labels.tolist(), zip(*[b.tolist() for b in boxStarts]),
+                                           zip(*[b.tolist() for b in boxEnds])):
+            if label > 0:
+                boundingBoxes[label - 1] = tuple(slice(s, e) for s, e in zip(boxStart, boxEnd))
+
+        return boundingBoxes
+
+    def getLabelMembershipMask(self, labels: typing.Iterable) -> np.ndarray:
+        """
+        Returns a boolean mask indicating the voxels whose values are in <labels>, formed by testing one value per run
+        :param labels: iterable of labels
+        :return: numpy.ndarray of dtype bool and of shape self.shape
+        """
+
+        mask = np.zeros(self.shape, dtype=bool)
+        inLabels = np.isin(self.runValues, np.asarray(list(labels)))
+        writeRuns(mask.reshape(-1), self.runStarts[inLabels], self.runLengths[inLabels],
+                  np.ones(inLabels.sum(), dtype=bool))
+
+        return mask
+
+    def getLabelSubset(self, labelSubset: typing.Iterable, inplace: bool = False) -> "RLELabelVolume":
+        """
+        Returns the volume with voxels with labels not in <labelSubset> set to zero, by dropping their runs
+        :param labelSubset: iterable of labels
+        :param inplace: bool, if True, this volume is modified and returned instead of a copy
+        :return: RLELabelVolume
+        """
+
+        inSubset = np.isin(self.runValues, np.asarray(list(labelSubset)))
+
+        return self._setRuns(self.runStarts[inSubset], self.runLengths[inSubset], self.runValues[inSubset], inplace)
+
+    def replaceLabels(self, labels2Replace: typing.Iterable, replaceValue,
+                      inplace: bool = False) -> "RLELabelVolume":
+        """
+        Replaces the values of voxels in <labels2Replace> with <replaceValue>, by changing the values of their runs.
+        Runs replaced by 0 are dropped and adjacent runs of the same value are merged.
+        :param labels2Replace: iterable of labels
+        :param replaceValue: value of type self.dtype
+        :param inplace: bool, if True, this volume is modified and returned instead of a copy
+        :return: RLELabelVolume
+        """
+
+        toReplace = np.isin(self.runValues, np.asarray(list(labels2Replace)))
+
+        if replaceValue == 0:
+            return self._setRuns(self.runStarts[~toReplace], self.runLengths[~toReplace], self.runValues[~toReplace],
+                                 inplace)
+
+        runValues = self.runValues.copy()
+        runValues[toReplace] = replaceValue
+
+        # adjacent runs in the same row that now have the same value
+        continuesRun = np.logical_and(self.runStarts[1:] == self.runStarts[:-1] + self.runLengths[:-1],
+                                      runValues[1:] == runValues[:-1])
+        continuesRun[self.runStarts[1:] % self.shape[2] == 0] = False
+        mergedRunStarts = np.flatnonzero(np.concatenate(([True], ~continuesRun)))[:runValues.shape[0]]
+
+        if mergedRunStarts.shape[0] == 0:
+            return self._setRuns(self.runStarts, self.runLengths, runValues, inplace)
+
+        return self._setRuns(self.runStarts[mergedRunStarts], np.add.reduceat(self.runLengths, mergedRunStarts),
+                             runValues[mergedRunStarts], inplace)
+
+    def _setRuns(self, runStarts: np.ndarray, runLengths: np.ndarray, runValues: np.ndarray,
+                 inplace: bool) -> "RLELabelVolume":
+
+        if inplace:
+            self.runStarts, self.runLengths, self.runValues = runStarts, runLengths, runValues
+            return self
+        else:
+            return RLELabelVolume(self.shape, self.dtype, runStarts, runLengths, runValues)
+
+
+def writeRuns(outFlat: np.ndarray, runStarts: np.ndarray, runLengths: np.ndarray, runValues: np.ndarray,
+              chunkVoxels: int = DEFAULT_CHUNK_VOXELS):
+    """
+    Writes the values of runs into a flat array, a chunk of runs covering about <chunkVoxels> voxels at a time
+    :param outFlat: numpy.ndarray, 1D
+    :param runStarts: numpy.ndarray of ints, index of the first voxel of each run in <outFlat>
+    :param runLengths: numpy.ndarray of ints, number of voxels of each run
+    :param runValues: numpy.ndarray, value of each run
+    :param chunkVoxels: int
+    """
+
+    runEnds = np.cumsum(runLengths)
+    chunkStarts = np.unique(np.searchsorted(runEnds, np.arange(0, runEnds[-1], chunkVoxels), side="right")) \
+        if runEnds.shape[0] else []
+
+    for chunkStart, chunkEnd in zip(chunkStarts, list(chunkStarts[1:]) + [runEnds.shape[0]]):
+
+        chunkRunLengths = runLengths[chunkStart: chunkEnd]
+        nChunkVoxels = int(chunkRunLengths.sum())
+
+        # voxel indices of the runs: a running count, shifted at every run to the start of the run
+        runOffsets = runStarts[chunkStart: chunkEnd] - (np.cumsum(chunkRunLengths) - chunkRunLengths)
+        voxelInds = np.arange(nChunkVoxels) + np.repeat(runOffsets, chunkRunLengths)
+
+        outFlat[voxelInds] = np.repeat(runValues[chunkStart: chunkEnd], chunkRunLengths)
@@ -1,30 +1,45 @@
 import SimpleITK as sitk
 import typing
+import itertools
 import numpy as np
 
 
-def getLabelShapeStatistics(image: typing.Union[np.ndarray, sitk.Image, str]) -> (list, list):
+def getLabelShapeStatistics(image: typing.Union[np.ndarray, sitk.Image, str],
+                            offset: typing.Tuple[int, ...] = None, columnar: bool = False) \
+        -> typing.Union[typing.Tuple[list, list], typing.Dict[str, np.ndarray]]:
     """
     Calculates shape statistics of an image
     :param image: Three options
-    1. numpy ndarray, image read in using scikit-image/matplotlib/pillow
+    1. numpy ndarray, image read in using scikit-image/matplotlib/pillow, or a memory-mapped one
     2. SimpleITK.Image, image read using SimpleITK
     3. str, path to a file containing an image
-    :return: measureNames, measureValues
+    :param offset: tuple of ints, in numpy order, e.g. (z, y, x). If <image> is a crop of a larger image, the position of
+    its first pixel in the larger image, so that centroids refer to the larger image
+    :param columnar: bool, if True, a dictionary of numpy arrays is returned instead of lists, which avoids creating a
+    Python list and rounding every value separately for every label
+    :return: measureNames, measureValues or, if <columnar> is True, measureArrays
     measureNames: list of strings, names of measures
     measureValues: list of lists, with one list per label. Each list consists of floats, with one float per measure.
     Measure values are ordered according to measure names in <measureNames>.
+    measureArrays: dictionary, with measure names as keys, in the order of <measureNames>, and numpy arrays with one row
+    per label as values, i.e., arrays of shape (<number of labels>, 3) for vector measures, "Centroid" and
+    "Principal Moments", and of shape (<number of labels>,) otherwise, or (0,) if there are no labels.
     """
 
     if type(image) == sitk.Image:
         pass
-    elif type(image) == np.ndarray:
+    elif isinstance(image, np.ndarray):
         image = sitk.GetImageFromArray(image)
     elif type(image) == str:
         image = sitk.ReadImage(image)
     else:
         raise(TypeError(f"Argument Image is of unknown type {type(image)}"))
 
+    if offset is not None:
+        offsetPoint = image.TransformContinuousIndexToPhysicalPoint([float(x) for x in offset[::-1]])
+        image = sitk.Image(image)
+        image.SetOrigin(offsetPoint)
+
     labelStats = sitk.LabelShapeStatisticsImageFilter()
     labelStats.ComputePerimeterOn()
     labelStats.Execute(image)
@@ -37,6 +52,9 @@ def getLabelShapeStatistics(image: typing.Union[np.ndarray, sitk.Image, str]) ->
              "Volume\n(number of pixels)": "GetNumberOfPixels",
              "Principal Moments": "GetPrincipalMoments"}
 
+    if columnar:
+        return getColumnarMeasureValues(labelStats, labels, funcs)
+
     measureValues = []
     for label in labels:
         labelMeasureValues = [label]
@@ -53,5 +71,40 @@ def getLabelShapeStatistics(image: typing.Union[np.ndarray, sitk.Image, str]) ->
     return ["Label Value"] + list(funcs.keys()), measureValues
 
 
+def getColumnarMeasureValues(labelStats: sitk.LabelShapeStatisticsImageFilter, labels: typing.Sequence[int],
+                             funcs: typing.Dict[str, str]) -> typing.Dict[str, np.ndarray]:
+    """
+    Collects measure values of labels from an executed label shape statistics filter into preallocated numpy arrays,
+    rounding float values to 6 decimals at once
+    :param labelStats: SimpleITK.LabelShapeStatisticsImageFilter, executed on a label image
+    :param labels: sequence of ints, labels of the label image
+    :param funcs: dictionary, with measure names as keys and names of methods of <labelStats> as values
+    :return: measureArrays, see getLabelShapeStatistics
+    """
+
+    nLabels = len(labels)
+
+    measureArrays = {"Label Value": np.fromiter(labels, dtype=np.int64, count=nLabels)}
+    for measureName, funcName in funcs.items():
+
+        func = getattr(labelStats, funcName)
+
+        # the dtype and shape of a measure are those of its value for the first label. Vector measures are read flat
+        # and reshaped, as numpy.fromiter supports subarray dtypes only from numpy 1.23
+        firstMeasureVal = func(labels[0]) if nLabels else 0.0
+        if hasattr(firstMeasureVal, "__iter__"):
+            nMeasureComponents = len(firstMeasureVal)
+            measureArray = np.fromiter(itertools.chain.from_iterable(func(label) for label in labels),
+                                       dtype=np.float64, count=nLabels * nMeasureComponents)
+            measureArray = measureArray.reshape((nLabels, nMeasureComponents))
+        else:
+            measureArray = np.fromiter((func(label) for label in labels),
+                                       dtype=np.int64 if isinstance(firstMeasureVal, int) else np.float64,
+                                       count=nLabels)
+
+        if measureArray.dtype.kind == "f":
+            np.round(measureArray, 6, out=measureArray)
 
+        measureArrays[measureName] = measureArray
 
+    return measureArrays
@@ -10,9 +10,10 @@ setup(
                       "pandas>=0.23",
                       "xlrd>=1.0.0",
                       "openpyxl>=2.4.5",
-                      "scikit-image>=0.14"
+                      "scikit-image>=0.14",
+                      "scipy>=1.0"
                       ],
 
-    python_requires=">=3.6"
+    python_requires=">=3.8"
 
 )
\ No newline at end of file
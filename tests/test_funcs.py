@@ -1,16 +1,54 @@
-from FarsightOPConv.core import FarsighOutputConverter
-from FarsightOPConv.app.coreFunction import farsightOPConvAndMetrics
+from FarsightOPConv.core import FarsighOutputConverter, replaceLabels, readSeeds, labelConnectedComponentsSlabwise
+from FarsightOPConv.app.coreFunction import farsightOPConvAndMetrics, shapeStatisticsDFGen, \
+    img16StackShapeStatisticsDFGen
 from FarsightOPConv.sitkFuncs import getLabelShapeStatistics
-from FarsightOPConv.img32bit16bitIO import labelConv32bitTo16bit
+from FarsightOPConv.img32bit16bitIO import labelConv32bitTo16bit, getIntegerShiftWindowFunc, \
+    iterLabelConv32bitTo16bit, relabelSequential, labelConv16bitTo32bit, loadImg16Stack
+from FarsightOPConv.rleLabelVolume import RLELabelVolume
+from FarsightOPConv.componentCache import ComponentCache, getFileContentHash, getComponentLabels
 import logging
+import pytest
 import pandas as pd
 import numpy as np
 from FarsightOPConv import tifffile
 import os
 import time
 import SimpleITK as sitk
+from skimage import measure
+from scipy import ndimage
 from ast import literal_eval as make_tuple
 
+
+def writeSyntheticFarsightOutput(dirPath, shape=(12, 60, 70), nObjects=80, nLabels=50, randomSeed=0):
+    """
+    Writes a small synthetic farsight output, i.e., a 16bit label image with some labels shared by disjoint objects and
+    a seed file with one seed per object plus a few seeds on background, into the directory <dirPath>
+    :return: (labelImageFile, seedsFile)
+    """
+
+    rng = np.random.RandomState(randomSeed)
+
+    objectCenters = np.stack([rng.randint(0, s, nObjects) for s in shape], axis=1)
+    objectLabels = rng.randint(1, nLabels + 1, nObjects).astype(np.uint16)
+
+    grid = np.stack(np.meshgrid(*[np.arange(s) for s in shape], indexing="ij"), axis=-1)
+    distances = np.stack([np.abs(grid - c).sum(axis=-1) for c in objectCenters], axis=-1)
+    nearestObject = distances.argmin(axis=-1)
+
+    labelImage = objectLabels[nearestObject]
+    labelImage[distances.min(axis=-1) > 5] = 0
+    labelImage[rng.rand(*shape) < 0.1] = 0
+
+    seeds = np.concatenate([objectCenters[:, ::-1],
+                            np.stack([rng.randint(0, s, 20) for s in shape[::-1]], axis=1)])
+
+    labelImageFile = os.path.join(str(dirPath), "syntheticLabel.tif")
+    seedsFile = os.path.join(str(dirPath), "syntheticSeedPoints.txt")
+    tifffile.imsave(labelImageFile, labelImage)
+    np.savetxt(seedsFile, seeds, fmt="%d")
+
+    return labelImageFile, seedsFile
+
 def test_separateMultipleLabels():
     """
     Testing the method FarsightOPConv.core.separateMultipleLabels
@@ -45,6 +83,331 @@ def test_separateMultipleLabels():
     assert all(successes)
 
 
+def test_getDesiredLabelsDF(tmp_path):
+    """
+    Testing the method FarsightOPConv.core.getDesiredLabelsDF against a seed by seed lookup
+    """
+
+    foc = FarsighOutputConverter(*writeSyntheticFarsightOutput(tmp_path))
+
+    desiredLabelsDF = foc.getDesiredLabelsDF()
+
+    expectedList = [(x, y, z, foc.labelImage[z, y, x], ind + 1)
+                    for ind, (x, y, z) in enumerate(foc.seeds) if foc.labelImage[z, y, x] > 0]
+    expectedDF = pd.DataFrame(data=expectedList, columns=desiredLabelsDF.columns)
+
+    assert desiredLabelsDF.equals(expectedDF)
+
+
+def test_readSeeds(tmp_path):
+    """
+    Testing the function FarsightOPConv.core.readSeeds, with and without the sidecar cache file
+    """
+
+    _, seedsFile = writeSyntheticFarsightOutput(tmp_path)
+    cacheFile = f"{seedsFile}.seedCache.npz"
+
+    expectedSeeds = np.loadtxt(seedsFile, dtype=int)
+
+    assert np.array_equal(readSeeds(seedsFile), expectedSeeds)
+    assert not os.path.isfile(cacheFile)
+
+    assert np.array_equal(readSeeds(seedsFile, useCache=True), expectedSeeds)
+    assert os.path.isfile(cacheFile)
+    assert np.array_equal(readSeeds(seedsFile, useCache=True), expectedSeeds)
+
+    with open(seedsFile, "a") as fle:
+        fle.write("1 2 3\n")
+
+    assert np.array_equal(readSeeds(seedsFile, useCache=True), np.concatenate([expectedSeeds, [[1, 2, 3]]]))
+
+    commentedSeedsFile = os.path.join(str(tmp_path), "commentedSeedPoints.txt")
+    with open(commentedSeedsFile, "w") as fle:
+        fle.write("# X Y Z\n1 2 3\n4 5 6\n")
+    assert np.array_equal(readSeeds(commentedSeedsFile), [[1, 2, 3], [4, 5, 6]])
+
+    malformedSeedsFile = os.path.join(str(tmp_path), "malformedSeedPoints.txt")
+    with open(malformedSeedsFile, "w") as fle:
+        fle.write("1 2 3\nfoo\n")
+    with pytest.raises((ValueError, AssertionError)):
+        readSeeds(malformedSeedsFile)
+
+
+def test_lazyLabelImage(tmp_path):
+    """
+    Testing lazy reading of label images in FarsightOPConv.core.FarsighOutputConverter, for memory-mappable and
+    compressed TIFF files
+    """
+
+    labelImageFile, seedsFile = writeSyntheticFarsightOutput(tmp_path)
+    compressedLabelImageFile = os.path.join(str(tmp_path), "syntheticLabelCompressed.tif")
+    tifffile.imsave(compressedLabelImageFile, tifffile.imread(labelImageFile), compress=6)
+
+    foc = FarsighOutputConverter(labelImageFile, seedsFile)
+
+    for testLabelFile in [labelImageFile, compressedLabelImageFile]:
+
+        focLazy = FarsighOutputConverter(testLabelFile, seedsFile, lazy=True)
+
+        assert isinstance(focLazy.labelImage, np.memmap)
+        assert np.array_equal(focLazy.labelImage, foc.labelImage)
+        assert focLazy.getDesiredLabelsDF().equals(foc.getDesiredLabelsDF())
+
+
+def test_rleLabelVolume(tmp_path):
+    """
+    Testing run-length encoded label images in FarsightOPConv.core.FarsighOutputConverter and
+    FarsightOPConv.core.replaceLabels against those held as numpy arrays
+    """
+
+    labelImageFile, seedsFile = writeSyntheticFarsightOutput(tmp_path)
+
+    foc = FarsighOutputConverter(labelImageFile, seedsFile)
+    focRLE = FarsighOutputConverter(labelImageFile, seedsFile, lazy=True, rle=True)
+
+    assert isinstance(focRLE.labelImage, RLELabelVolume)
+    assert np.array_equal(focRLE.labelImage.toArray(), foc.labelImage)
+    assert np.array_equal(focRLE.labelImage[3, 10:40, -25:], foc.labelImage[3, 10:40, -25:])
+    assert np.array_equal(focRLE.getSeedLabels(), foc.getSeedLabels())
+    assert focRLE.getDesiredLabelsDF().equals(foc.getDesiredLabelsDF())
+    assert focRLE.getLabelBoundingBoxes() == foc.getLabelBoundingBoxes()
+    assert focRLE.getAllLabelsSeparability().equals(foc.getAllLabelsSeparability())
+
+    relabelledImage, newOldLabelMap = foc.separateMultipleLabels()
+    relabelledImageRLE, newOldLabelMapRLE = focRLE.separateMultipleLabels(slabSize=5)
+    assert np.array_equal(relabelledImageRLE, relabelledImage)
+    assert newOldLabelMapRLE == newOldLabelMap
+
+    labelSubset = tuple(np.unique(foc.labelImage)[1::3])
+    subsetLabelImage, subsetSeeds = foc.getLabelSubsetImage(labelSubset)
+    subsetLabelImageRLE, subsetSeedsRLE = focRLE.getLabelSubsetImage(labelSubset)
+    assert isinstance(subsetLabelImageRLE, RLELabelVolume)
+    assert np.array_equal(subsetLabelImageRLE.toArray(), subsetLabelImage)
+    assert np.array_equal(subsetSeedsRLE, subsetSeeds)
+
+    labels2Replace = [foc.labelImage.dtype.type(x) for x in labelSubset]
+    for replaceValue in [0, labels2Replace[0]]:
+        expectedImage = replaceLabels(foc.labelImage, labels2Replace, replaceValue)
+        replacedImageRLE = replaceLabels(focRLE.labelImage, labels2Replace, replaceValue)
+        assert np.array_equal(replacedImageRLE.toArray(), expectedImage)
+        # runs of the same value are merged, as if the replaced image was encoded
+        assert replacedImageRLE.runValues.shape == RLELabelVolume.fromArray(expectedImage).runValues.shape
+
+    focRLE.getLabelSubsetImage(labelSubset, inplace=True)
+    assert np.array_equal(focRLE.labelImage.toArray(), subsetLabelImage)
+    assert focRLE.getLabelBoundingBoxes() == ndimage.find_objects(subsetLabelImage)
+
+
+def test_labelSeedIndex(tmp_path):
+    """
+    Testing the inverted label seed index FarsightOPConv.core.FarsighOutputConverter.labelSeedIndex
+    """
+
+    foc = FarsighOutputConverter(*writeSyntheticFarsightOutput(tmp_path))
+
+    seedLabels = np.array([foc.labelImage[z, y, x] for x, y, z in foc.seeds])
+
+    for label in range(foc.labelImage.max() + 2):
+        assert np.array_equal(foc.labelSeedIndex.getSeedIndices(label), np.flatnonzero(seedLabels == label))
+        assert np.array_equal(foc.getLabelSeeds(label), foc.seeds[seedLabels == label])
+
+    assert np.array_equal(foc.labelSeedIndex.getFirstSeedIndices(),
+                          [np.flatnonzero(seedLabels == x)[0] for x in np.unique(seedLabels)])
+
+
+def test_getLabelSeparability(tmp_path):
+    """
+    Testing the method FarsightOPConv.core.getLabelSeparability against connected components of the full volume
+    """
+
+    foc = FarsighOutputConverter(*writeSyntheticFarsightOutput(tmp_path))
+
+    seedLabels = foc.getSeedLabels()
+
+    for label in np.unique(seedLabels[seedLabels > 0]):
+
+        labelSeeds = [tuple(x) for x in foc.seeds[seedLabels == label]]
+
+        separability, separatedSeedLabels = foc.getLabelSeparability(label, labelSeeds)
+
+        expectedSeparatedLabelImage = measure.label(foc.labelImage == label, background=0, connectivity=2)
+        expectedSeparatedSeedLabels = [expectedSeparatedLabelImage[z, y, x] for x, y, z in labelSeeds]
+        expectedSeparability = [x not in expectedSeparatedSeedLabels[:ind]
+                                for ind, x in enumerate(expectedSeparatedSeedLabels)]
+
+        assert separatedSeedLabels == expectedSeparatedSeedLabels
+        assert separability == expectedSeparability
+
+
+def test_getAllLabelsSeparability(tmp_path):
+    """
+    Testing the method FarsightOPConv.core.getAllLabelsSeparability against FarsightOPConv.core.getLabelSeparability
+    """
+
+    foc = FarsighOutputConverter(*writeSyntheticFarsightOutput(tmp_path))
+
+    separabilityDF = foc.getAllLabelsSeparability()
+
+    for label, labelDF in separabilityDF.groupby("Farsight Output Label"):
+
+        labelSeeds = [tuple(x) for x in labelDF[["Seed X\n(pixels)", "Seed Y\n(pixels)", "Seed Z\n(pixels)"]].values]
+
+        separability, separatedSeedLabels = foc.getLabelSeparability(label, labelSeeds)
+
+        assert separability == labelDF["Separable"].tolist()
+        assert separatedSeedLabels == labelDF["Separated Label"].tolist()
+
+
+def test_separateMultipleLabels_slabwise(tmp_path):
+    """
+    Testing slab wise and parallel labelling of connected components in FarsightOPConv.core.separateMultipleLabels
+    """
+
+    foc = FarsighOutputConverter(*writeSyntheticFarsightOutput(tmp_path))
+
+    expectedImage, expectedLabelMap = foc.separateMultipleLabels()
+
+    for slabSize in [1, 4, foc.labelImage.shape[0]]:
+
+        relabelledImage, newOldLabelMap = foc.separateMultipleLabels(slabSize=slabSize)
+
+        assert isinstance(relabelledImage, np.memmap)
+        assert np.array_equal(relabelledImage, expectedImage)
+        assert newOldLabelMap == expectedLabelMap
+
+    relabelledImage, newOldLabelMap = foc.separateMultipleLabels(nWorkers=2)
+    assert np.array_equal(relabelledImage, expectedImage)
+    assert newOldLabelMap == expectedLabelMap
+
+    for dtype in [np.uint32, np.uint16]:
+        relabelledImage, newOldLabelMap = foc.separateMultipleLabels(dtype=dtype)
+        assert relabelledImage.dtype == dtype
+        assert np.array_equal(relabelledImage, expectedImage)
+        assert newOldLabelMap == expectedLabelMap
+
+    noiseImage = np.random.RandomState(0).randint(0, 3, (9, 20, 25))
+    for connectivity in [1, 2, 3]:
+        expectedNoiseLabels = measure.label(noiseImage, connectivity=connectivity)
+        for nWorkers in [1, 3]:
+            assert np.array_equal(labelConnectedComponentsSlabwise(noiseImage, 2, connectivity=connectivity,
+                                                                   nWorkers=nWorkers),
+                                  expectedNoiseLabels)
+
+    # 10000 z-columns, i.e., 200000 labels of slabs of one z-plane, but 10000 labels after merging slabs
+    columnsImage = np.zeros((20, 200, 200), dtype=np.uint16)
+    columnsImage[:, ::2, ::2] = 1
+    expectedColumnLabels = measure.label(columnsImage, connectivity=2)
+    columnLabels = labelConnectedComponentsSlabwise(columnsImage, 1, dtype=np.uint16)
+    assert columnLabels.dtype == np.uint16
+    assert np.array_equal(columnLabels, expectedColumnLabels)
+
+    with pytest.raises(AssertionError, match="Number of labels exceeds the range of uint8"):
+        labelConnectedComponentsSlabwise(columnsImage, 1, dtype=np.uint8)
+
+
+def test_extractSeededComponents(tmp_path):
+    """
+    Testing the method FarsightOPConv.core.extractSeededComponents against FarsightOPConv.core.separateMultipleLabels
+    followed by removal of components without seeds
+    """
+
+    foc = FarsighOutputConverter(*writeSyntheticFarsightOutput(tmp_path))
+
+    relabelledImage, _ = foc.separateMultipleLabels()
+
+    seededLabels = np.unique(relabelledImage[foc.seeds[:, 2], foc.seeds[:, 1], foc.seeds[:, 0]])
+    seededLabels = seededLabels[seededLabels > 0]
+    sequentialLabelLUT = np.zeros(relabelledImage.max() + 1, dtype=np.int64)
+    sequentialLabelLUT[seededLabels] = np.arange(1, seededLabels.shape[0] + 1)
+    expectedImage = sequentialLabelLUT[relabelledImage]
+
+    seededComponentsImage, newOldLabelMap = foc.extractSeededComponents()
+
+    assert np.array_equal(seededComponentsImage, expectedImage)
+    assert all(foc.labelImage[seededComponentsImage == x][0] == y for x, y in newOldLabelMap.items() if x > 0)
+
+    for slabSize in [1, 5]:
+        out = np.zeros(foc.labelImage.shape, dtype=np.uint32)
+        slabwiseImage, _ = foc.extractSeededComponents(out=out, slabSize=slabSize)
+        assert slabwiseImage is out
+        assert np.array_equal(slabwiseImage, expectedImage)
+
+    for kwargs in [{"lazy": True}, {"rle": True}]:
+        otherFOC = FarsighOutputConverter(foc.outputlabelImageFile, foc.outputSeedsTXT, **kwargs)
+        assert np.array_equal(otherFOC.extractSeededComponents(slabSize=3)[0], expectedImage)
+
+    seededLabels = np.unique(foc.getSeedLabels())
+    subsetImage = np.where(np.isin(foc.labelImage, seededLabels), foc.labelImage, 0)
+    for nWorkers in [1, 2]:
+        assert np.array_equal(labelConnectedComponentsSlabwise(foc.labelImage, 4, nWorkers=nWorkers,
+                                                               labelSubset=seededLabels),
+                              measure.label(subsetImage, connectivity=2))
+
+
+def test_getLabelSubsetImage_inplaceAndOut(tmp_path):
+    """
+    Testing the arguments inplace and out of the method FarsightOPConv.core.getLabelSubsetImage
+    """
+
+    foc = FarsighOutputConverter(*writeSyntheticFarsightOutput(tmp_path))
+
+    labelSubset = np.unique(foc.labelImage)[1::3]
+
+    expectedImage = np.where(np.isin(foc.labelImage, labelSubset), foc.labelImage, 0)
+    expectedSeeds = [x for x in foc.seeds if expectedImage[x[2], x[1], x[0]] > 0]
+
+    outImage = np.full_like(foc.labelImage, 7)
+    subsetLabelImage, subsetSeeds = foc.getLabelSubsetImage(labelSubset, out=outImage)
+    assert subsetLabelImage is outImage
+    assert np.array_equal(outImage, expectedImage)
+    assert np.array_equal(subsetSeeds, expectedSeeds)
+
+    subsetLabelImage, subsetSeeds = foc.getLabelSubsetImage(labelSubset, inplace=True)
+    assert subsetLabelImage is foc.labelImage
+    assert np.array_equal(foc.labelImage, expectedImage)
+    assert np.array_equal(subsetSeeds, expectedSeeds)
+    assert all(foc.getLabelBoundingBox(x) is None
+               for x in np.unique(foc.labelImage) if x not in labelSubset and x > 0)
+
+
+def test_componentCache(tmp_path):
+    """
+    Testing the class FarsightOPConv.componentCache.ComponentCache
+    """
+
+    labelImageFile, seedsFile = writeSyntheticFarsightOutput(str(tmp_path))
+
+    foc = FarsighOutputConverter(labelImageFile, seedsFile)
+    relabelledImage, newOldLabelDict = foc.separateMultipleLabels(dtype=np.uint32)
+    componentLabels = getComponentLabels(relabelledImage, foc.labelImage)
+
+    for newLabel, oldLabel in newOldLabelDict.items():
+        assert componentLabels[newLabel] == oldLabel
+
+    labelImageHash = getFileContentHash(labelImageFile)
+    assert labelImageHash == getFileContentHash(labelImageFile)
+    assert labelImageHash != getFileContentHash(seedsFile)
+
+    componentCache = ComponentCache(str(tmp_path / "cache"), labelImageHash)
+    assert not componentCache.hasComponents()
+    assert componentCache.loadStatistics().empty
+
+    componentCache.saveComponents(relabelledImage, componentLabels)
+    assert componentCache.hasComponents()
+
+    cachedRelabelledImage, cachedComponentLabels = componentCache.loadComponents()
+    assert np.array_equal(cachedRelabelledImage, relabelledImage)
+    assert np.array_equal(cachedComponentLabels, componentLabels)
+
+    # loaded connected components are copy-on-write
+    cachedRelabelledImage[:] = 0
+    assert np.array_equal(componentCache.loadComponents()[0], relabelledImage)
+
+    statisticsDF = pd.DataFrame({"Volume": [3, 5]}, index=pd.Index([2, 7], name="New Label"))
+    componentCache.saveStatistics(statisticsDF)
+    assert componentCache.loadStatistics().equals(statisticsDF)
+
+
 def test_getLabelSubsetImage():
     """Testing the function FarsightOPConv.core.getLabelSubsetImage"""
 
@@ -70,6 +433,37 @@ def test_getLabelSubsetImage():
     assert temp == set(subsetLabels)
 
 
+def test_replaceLabels():
+    """
+    Testing the function FarsightOPConv.core.replaceLabels for lookup table and numpy.isin based replacements
+    """
+
+    rng = np.random.RandomState(0)
+
+    for dtype, low, high in [(np.uint16, 0, 2 ** 16), (np.uint32, 0, 5000), (np.int64, 0, 2 ** 40), (np.int32, -300, 300)]:
+
+        image = rng.randint(low, high, (5, 30, 40), dtype=np.int64).astype(dtype)
+        labels2Replace = [dtype(x) for x in rng.choice(np.unique(image), 40)]
+
+        labels2ReplaceFrozenSet = frozenset(labels2Replace)
+        expectedImage = image.copy()
+        expectedImage[np.vectorize(lambda x: x in labels2ReplaceFrozenSet)(image)] = 0
+
+        replacedImage = replaceLabels(image, labels2Replace, 0)
+
+        assert replacedImage.dtype == image.dtype
+        assert np.array_equal(replacedImage, expectedImage)
+        assert np.array_equal(next(replaceLabels(image, labels2Replace, 0, makeGenerator=True)), expectedImage)
+
+        outImage = np.empty_like(image)
+        assert replaceLabels(image, labels2Replace, 0, out=outImage) is outImage
+        assert np.array_equal(outImage, expectedImage)
+
+        inplaceImage = image.copy()
+        assert replaceLabels(inplaceImage, labels2Replace, 0, inplace=True) is inplaceImage
+        assert np.array_equal(inplaceImage, expectedImage)
+
+
 def test_coreFunction_small():
     """
     Testing FarsighOPConv.app.coreFunction with a short runtime case
@@ -100,6 +494,93 @@ def test_coreFunction_small():
     assert pd.read_excel(outXLFile).equals(pd.read_excel(expOutXLFile))
 
 
+def test_coreFunction_synthetic(tmp_path):
+    """
+    Testing FarsighOPConv.app.coreFunction on synthetic data, with and without a component cache
+    """
+
+    labelImageFile, seedsFile = writeSyntheticFarsightOutput(tmp_path)
+
+    foc = FarsighOutputConverter(labelImageFile, seedsFile)
+    relabelledImage, newOldLabelMap = foc.separateMultipleLabels()
+    seededLabels = [x for x in newOldLabelMap if x > 0]
+    expectedImage = np.where(np.isin(relabelledImage, seededLabels), relabelledImage, 0)
+
+    outLabelFile, outXLFile = farsightOPConvAndMetrics(labelImageFile, seedsFile)
+    outDF = pd.read_excel(outXLFile)
+
+    assert np.array_equal(tifffile.imread(outLabelFile), expectedImage)
+    assert outDF["New Label"].tolist() == sorted(seededLabels)
+    assert outDF["Farsight Output Label"].tolist() == [newOldLabelMap[x] for x in sorted(seededLabels)]
+    assert (outDF["Volume\n(number of pixels)"] == [(expectedImage == x).sum() for x in sorted(seededLabels)]).all()
+
+    for run in range(2):
+        cachedOutLabelFile, cachedOutXLFile = farsightOPConvAndMetrics(labelImageFile, seedsFile,
+                                                                       cacheDir=str(tmp_path / "cache"))
+        assert np.array_equal(tifffile.imread(cachedOutLabelFile), expectedImage)
+        assert pd.read_excel(cachedOutXLFile).equals(outDF)
+
+
+def test_coreFunction_cacheEditedSeeds(tmp_path):
+    """
+    Testing FarsighOPConv.app.coreFunction with a component cache, with the seed file edited between runs, against runs
+    without a cache
+    """
+
+    labelImageFile, seedsFile = writeSyntheticFarsightOutput(tmp_path)
+    allSeeds = np.loadtxt(seedsFile, dtype=int)
+
+    for seeds in [allSeeds[:40], allSeeds]:
+
+        np.savetxt(seedsFile, seeds, fmt="%d")
+
+        outLabelFile, outXLFile = farsightOPConvAndMetrics(labelImageFile, seedsFile)
+        expectedImage = tifffile.imread(outLabelFile)
+        expectedDF = pd.read_excel(outXLFile)
+
+        cachedOutLabelFile, cachedOutXLFile = farsightOPConvAndMetrics(labelImageFile, seedsFile,
+                                                                       cacheDir=str(tmp_path / "cache"))
+        assert np.array_equal(tifffile.imread(cachedOutLabelFile), expectedImage)
+        assert pd.read_excel(cachedOutXLFile).equals(expectedDF)
+
+
+def test_coreFunction_sparseLabels(tmp_path):
+    """
+    Testing FarsighOPConv.app.coreFunction on synthetic data with seeded connected component labels above 65535, with and
+    without a component cache
+    """
+
+    # isolated voxels of a single farsight label, i.e., 5 x 120 x 120 connected components numbered in raster order
+    labelImage = np.zeros((10, 240, 240), dtype=np.uint16)
+    labelImage[::2, ::2, ::2] = 1
+
+    seededComponents = np.array([1, 6, 70001, 71001])
+    seedsZYX = np.array(np.unravel_index(seededComponents - 1, (5, 120, 120))).T * 2
+
+    labelImageFile = os.path.join(str(tmp_path), "sparseLabel.tif")
+    seedsFile = os.path.join(str(tmp_path), "sparseSeedPoints.txt")
+    tifffile.imsave(labelImageFile, labelImage)
+    np.savetxt(seedsFile, seedsZYX[:, ::-1], fmt="%d")
+
+    outLabelFile, outXLFile = farsightOPConvAndMetrics(labelImageFile, seedsFile)
+    outDF = pd.read_excel(outXLFile)
+
+    assert outDF["New Label"].tolist() == seededComponents.tolist()
+    assert outDF["Sequential Label"].tolist() == [1, 2, 3, 4]
+    # statistics are calculated with compact packing, in a single 16bit image
+    assert outDF["Temporary\nInternal Label"].tolist() == [1, 2, 3, 4]
+
+    cachedOutLabelFile, cachedOutXLFile = farsightOPConvAndMetrics(labelImageFile, seedsFile,
+                                                                   cacheDir=str(tmp_path / "cache"))
+    assert np.array_equal(tifffile.imread(cachedOutLabelFile), tifffile.imread(outLabelFile))
+    assert pd.read_excel(cachedOutXLFile).equals(outDF)
+
+    stackOutLabelFile, stackOutXLFile = farsightOPConvAndMetrics(labelImageFile, seedsFile,
+                                                                 img16StackFile=str(tmp_path / "img16Stack.npy"))
+    assert loadImg16Stack(str(tmp_path / "img16Stack.npy")).shape == (1,) + labelImage.shape
+    assert pd.read_excel(stackOutXLFile).equals(outDF)
+
+
 def test_coreFunction_medium():
     """
     Testing FarsighOPConv.app.coreFunction with a medium runtime case
@@ -191,6 +672,51 @@ def test_getLabelShapeStats():
     assert outDF.equals(expected_outDF)
 
 
+def test_getLabelShapeStats_offset(tmp_path):
+    """
+    Testing the function FarsightOPConv.sitkFuncs.getLabelShapeStatistics on label crops with offsets against the full
+    label image
+    """
+
+    labelImage = tifffile.imread(writeSyntheticFarsightOutput(tmp_path)[0])
+    labelImage = measure.label(labelImage, connectivity=2).astype(np.uint16)
+
+    measureNames, measureValues = getLabelShapeStatistics(labelImage)
+
+    for labelMeasureValues, boundingBox in zip(measureValues, ndimage.find_objects(labelImage)):
+
+        label = labelMeasureValues[0]
+        labelCrop = np.where(labelImage[boundingBox] == label, labelImage[boundingBox], 0)
+
+        cropMeasureNames, cropMeasureValues = getLabelShapeStatistics(labelCrop,
+                                                                      offset=tuple(x.start for x in boundingBox))
+
+        assert cropMeasureNames == measureNames
+        assert np.allclose(np.hstack(cropMeasureValues[0]), np.hstack(labelMeasureValues))
+
+
+def test_getLabelShapeStats_columnar(tmp_path):
+    """
+    Testing the columnar output of the function FarsightOPConv.sitkFuncs.getLabelShapeStatistics against its list output
+    """
+
+    labelImage = tifffile.imread(writeSyntheticFarsightOutput(tmp_path)[0])
+    labelImage = measure.label(labelImage, connectivity=2).astype(np.uint16)
+
+    measureNames, measureValues = getLabelShapeStatistics(labelImage)
+    measureArrays = getLabelShapeStatistics(labelImage, columnar=True)
+
+    assert list(measureArrays.keys()) == measureNames
+
+    for measureInd, measureName in enumerate(measureNames):
+        assert measureArrays[measureName].shape[0] == len(measureValues)
+        assert np.array_equal(measureArrays[measureName], np.array([x[measureInd] for x in measureValues]))
+
+    emptyMeasureArrays = getLabelShapeStatistics(np.zeros((2, 3, 4), dtype=np.uint16), columnar=True)
+    assert list(emptyMeasureArrays.keys()) == measureNames
+    assert all(x.shape[0] == 0 for x in emptyMeasureArrays.values())
+
+
 def test_labelConv32bitTo16bit():
     """
     Testing the function FarsightOPConv.img32bit16bitIO.labelConv32bitTo16bit
@@ -218,6 +744,193 @@ def test_labelConv32bitTo16bit():
         assert np.allclose(expOPImage, opImg)
 
 
+
+def test_getIntegerShiftWindowFunc():
+    """
+    Testing the function FarsightOPConv.img32bit16bitIO.getIntegerShiftWindowFunc against a pixel-wise implementation
+    """
+
+    rng = np.random.RandomState(0)
+    img32 = rng.randint(0, 200000, (5, 30, 40)).astype(np.uint32)
+
+    for nLabels2Retain, inputStart, outputStart in [(2 ** 16 - 1, 1, 1), (2 ** 16 - 1, 2 ** 16, 1), (100, 50, 200),
+                                                    (70000, 1, 1)]:
+
+        labelMapFunc, ipLast = getIntegerShiftWindowFunc(nLabels2Retain, inputStart, outputStart)
+
+        assert ipLast == inputStart + nLabels2Retain - 1
+
+        expectedImage = np.array([x - inputStart + outputStart if inputStart <= x <= ipLast else 0
+                                  for x in img32.ravel().tolist()]).reshape(img32.shape)
+
+        assert np.array_equal(labelMapFunc(img32), expectedImage)
+
+        if expectedImage.max() < 2 ** 16:
+            outImage = np.empty(img32.shape, dtype=np.uint16)
+            assert labelMapFunc(img32, out=outImage) is outImage
+            assert np.array_equal(outImage, expectedImage)
+
+
+def test_labelConv32bitTo16bit_synthetic():
+    """
+    Testing the function FarsightOPConv.img32bit16bitIO.labelConv32bitTo16bit against a window-wise decomposition,
+    with labels spread over several 16bit images
+    """
+
+    rng = np.random.RandomState(0)
+    img32 = np.where(rng.rand(5, 30, 40) < 0.3, 0, rng.randint(1, 200000, (5, 30, 40))).astype(np.uint32)
+
+    imgs16Bit, labelMap = labelConv32bitTo16bit(img32)
+
+    nLabelsImg16 = 2 ** 16 - 1
+    assert len(imgs16Bit) == int(np.ceil(img32.max() / nLabelsImg16))
+
+    for outImageInd, img16Bit in enumerate(imgs16Bit):
+        labelMapFunc, ipLast = getIntegerShiftWindowFunc(nLabelsImg16, 1 + outImageInd * nLabelsImg16, 1)
+        assert img16Bit.dtype == np.uint16
+        assert np.array_equal(img16Bit, labelMapFunc(img32))
+
+    croppedImgs16Bit, croppedLabelMap, offsets = labelConv32bitTo16bit(img32, cropToLabels=True)
+
+    assert croppedLabelMap.equals(labelMap)
+
+    for img16Bit, croppedImg16Bit, offset in zip(imgs16Bit, croppedImgs16Bit, offsets):
+        boundingBox = tuple(slice(start, start + size) for start, size in zip(offset, croppedImg16Bit.shape))
+        assert np.array_equal(croppedImg16Bit, img16Bit[boundingBox])
+        assert ndimage.find_objects((img16Bit > 0).astype(np.uint8))[0] == boundingBox
+
+    for cropToLabels, expectedImgs16Bit in [(False, imgs16Bit), (True, croppedImgs16Bit)]:
+
+        iteratedOutputs = list(iterLabelConv32bitTo16bit(img32, cropToLabels=cropToLabels))
+
+        assert [x[0] for x in iteratedOutputs] == list(range(len(imgs16Bit)))
+        assert all(np.array_equal(x[1], y) for x, y in zip(iteratedOutputs, expectedImgs16Bit))
+        assert pd.concat([x[2] for x in iteratedOutputs]).equals(labelMap)
+        if cropToLabels:
+            assert [x[3] for x in iteratedOutputs] == offsets
+
+    assert list(labelMap.columns) == ["Input Label", "Output Image Index", "Output Label"]
+    assert np.array_equal(labelMap["Input Label"], np.setdiff1d(img32, [0]))
+    for inputLabel, outImageInd, outputLabel in labelMap.values[::97]:
+        assert imgs16Bit[outImageInd][img32 == inputLabel].tolist() == [outputLabel] * (img32 == inputLabel).sum()
+
+
+def test_labelConv32bitTo16bit_coloured(tmp_path):
+    """
+    Testing coloured packing of FarsightOPConv.img32bit16bitIO.labelConv32bitTo16bit, i.e., that every input label is
+    a connected component of its output label and that touching input labels have different output labels
+    """
+
+    labelImage = tifffile.imread(writeSyntheticFarsightOutput(tmp_path)[0])
+    img32 = measure.label(labelImage, connectivity=2).astype(np.uint32)
+    img32[img32 > 0] = img32[img32 > 0] * 2999 + 7
+
+    imgs16Bit, labelMap = labelConv32bitTo16bit(img32, packing="coloured")
+
+    assert len(imgs16Bit) == 1 < len(labelConv32bitTo16bit(img32)[0])
+    assert np.array_equal(labelMap["Input Label"], np.setdiff1d(img32, [0]))
+
+    img16Components = measure.label(imgs16Bit[0], connectivity=3)
+    for inputLabel, outImageInd, outputLabel in labelMap.values:
+        inputLabelMask = img32 == inputLabel
+        assert outImageInd == 0
+        assert (imgs16Bit[0][inputLabelMask] == outputLabel).all()
+        assert np.array_equal(img16Components == img16Components[inputLabelMask][0], inputLabelMask)
+
+    croppedImgs16Bit, croppedLabelMap, offsets = labelConv32bitTo16bit(img32, cropToLabels=True, packing="coloured")
+
+    assert croppedLabelMap.equals(labelMap)
+    assert np.array_equal(croppedImgs16Bit[0],
+                          imgs16Bit[0][tuple(slice(x, x + y) for x, y in zip(offsets[0], croppedImgs16Bit[0].shape))])
+
+
+def test_labelConv32bitTo16bit_compact():
+    """
+    Testing the function FarsightOPConv.img32bit16bitIO.relabelSequential and compact packing of
+    FarsightOPConv.img32bit16bitIO.labelConv32bitTo16bit for sparse labels
+    """
+
+    rng = np.random.RandomState(0)
+    sparseLabels = np.unique(rng.randint(1, 2 ** 18, 500)).astype(np.uint32)
+    img32 = np.where(rng.rand(5, 30, 40) < 0.3, 0, rng.choice(sparseLabels, (5, 30, 40))).astype(np.uint32)
+    labels = np.setdiff1d(img32, [0])
+
+    relabelled, forwardMap, inverseMap = relabelSequential(img32)
+
+    assert relabelled.dtype == img32.dtype
+    assert np.array_equal(np.unique(relabelled), np.arange(labels.shape[0] + 1))
+    assert np.array_equal(inverseMap[relabelled], img32)
+    assert np.array_equal(forwardMap[img32], relabelled)
+    assert np.array_equal(inverseMap[1:], labels)
+
+    inplaceImage = img32.copy()
+    assert relabelSequential(inplaceImage, out=inplaceImage)[0] is inplaceImage
+    assert np.array_equal(inplaceImage, relabelled)
+
+    imgs16Bit, labelMap = labelConv32bitTo16bit(img32, packing="compact")
+    expectedImgs16Bit, expectedLabelMap = labelConv32bitTo16bit(relabelled)
+
+    assert len(imgs16Bit) == 1 < len(labelConv32bitTo16bit(img32)[0])
+    assert all(np.array_equal(x, y) for x, y in zip(imgs16Bit, expectedImgs16Bit))
+    assert np.array_equal(labelMap["Input Label"], labels)
+    assert np.array_equal(labelMap["Output Label"], expectedLabelMap["Output Label"])
+
+
+def test_labelConv16bitTo32bit(tmp_path):
+    """
+    Testing the function FarsightOPConv.img32bit16bitIO.labelConv16bitTo32bit as inverse of
+    FarsightOPConv.img32bit16bitIO.labelConv32bitTo16bit, for lists and iterators of 16bit images
+    """
+
+    rng = np.random.RandomState(0)
+    img32 = np.where(rng.rand(5, 30, 40) < 0.3, 0, rng.randint(1, 200000, (5, 30, 40))).astype(np.uint32)
+
+    for packing in ["sequential", "compact"]:
+
+        imgs16Bit, labelMap = labelConv32bitTo16bit(img32, packing=packing)
+
+        assert np.array_equal(labelConv16bitTo32bit(imgs16Bit, labelMap), img32)
+
+        iteratedImgs16Bit = (x[1] for x in iterLabelConv32bitTo16bit(img32, packing=packing))
+        assert np.array_equal(labelConv16bitTo32bit(iteratedImgs16Bit, labelMap), img32)
+
+        croppedImgs16Bit, croppedLabelMap, offsets = labelConv32bitTo16bit(img32, cropToLabels=True, packing=packing)
+
+        outImage = np.memmap(str(tmp_path / f"merged_{packing}.dat"), dtype=np.uint32, mode="w+", shape=img32.shape)
+        assert labelConv16bitTo32bit(croppedImgs16Bit, croppedLabelMap, out=outImage, offsets=offsets) is outImage
+        assert np.array_equal(outImage, img32)
+        assert np.array_equal(labelConv16bitTo32bit(croppedImgs16Bit, croppedLabelMap, shape=img32.shape,
+                                                    offsets=offsets), img32)
+
+
+def test_labelConv32bitTo16bit_outFile(tmp_path):
+    """
+    Testing writing the output of the function FarsightOPConv.img32bit16bitIO.labelConv32bitTo16bit into memory-mapped
+    stacks, and calculating shape statistics from them
+    """
+
+    rng = np.random.RandomState(1)
+    img32 = np.where(rng.rand(4, 20, 30) < 0.5, 0, rng.randint(1, 150000, (4, 20, 30))).astype(np.uint32)
+
+    for packing in ["sequential", "compact"]:
+
+        imgs16Bit, labelMap = labelConv32bitTo16bit(img32, packing=packing)
+        expectedStatsDF = pd.concat(shapeStatisticsDFGen(img32, packing=packing)).sort_index()
+
+        for suffix in [".npy", ".tif"]:
+
+            stackFile = str(tmp_path / f"stack_{packing}{suffix}")
+            stackImgs16Bit, stackLabelMap = labelConv32bitTo16bit(img32, packing=packing, outFile=stackFile)
+
+            pd.testing.assert_frame_equal(stackLabelMap, labelMap)
+
+            img16Stack = loadImg16Stack(stackFile)
+            assert img16Stack.shape == (len(imgs16Bit),) + img32.shape
+            assert all(np.array_equal(x, y) for x, y in zip(img16Stack, imgs16Bit))
+
+            statsDF = pd.concat(img16StackShapeStatisticsDFGen(stackFile, labelMap)).sort_index()
+            pd.testing.assert_frame_equal(statsDF, expectedStatsDF)
+
 if __name__ == "__main__":
     test_coreFunction_medium()
     np.logical_or